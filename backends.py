@@ -0,0 +1,137 @@
+"""Where clips are uploaded to, set with UPLOAD_BACKEND in the config file.
+
+Each backend builds a client per upload thread and uploads an encoded clip
+with it. YouTube goes through the resumable upload in upload.py, S3 (or any
+S3-compatible storage, e.g MinIO) uploads the parts of large clips in
+parallel. Their libraries are only imported once something is uploaded.
+"""
+import os
+import threading
+import initconfig
+from instrument import stage
+from quota import QuotaExceeded, is_quota_error
+from upload import (CredentialRefresher, UploadError, format_bytes, get_authenticated_service,
+                    initialize_upload, resume_pending_uploads, upload_bucket)
+
+
+class UploadBackend():
+    name = None
+    # Whether uploads are charged to the daily API quota, see quota.py
+    quota = False
+
+    def start(self):
+        """Called once before anything is uploaded"""
+        pass
+
+    def client(self):
+        """A client for the calling thread"""
+        raise NotImplementedError
+
+    def upload(self, client, clip, journal=None, log=print):
+        """Uploads clip.clip_file_name, raises UploadError if it fails"""
+        raise NotImplementedError
+
+    def resume(self, journal):
+        """Finishes the uploads a previous run left in the journal, returns their sources"""
+        return []
+
+
+class YoutubeBackend(UploadBackend):
+    name = "youtube"
+    quota = True
+
+    def start(self):
+        # The service is only built once something is uploaded
+        CredentialRefresher().start()
+
+    def client(self):
+        return get_authenticated_service()
+
+    def upload(self, client, clip, journal=None, log=print):
+        from apiclient.errors import HttpError
+
+        try:
+            return initialize_upload(client, clip, journal=journal, log=log)
+        except HttpError as e:
+            if is_quota_error(e):
+                raise QuotaExceeded("The daily upload quota ran out.")
+            raise UploadError(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
+
+    def resume(self, journal):
+        if not journal.pending():
+            return []
+        return resume_pending_uploads(get_authenticated_service(), journal)
+
+
+class S3Backend(UploadBackend):
+    """Uploads to a bucket, clips larger than a part are sent as parallel multipart uploads
+
+    Each thread gets its own client, the parts of a clip share its
+    connection pool, which has a connection per part worker.
+    """
+    name = "s3"
+
+    def __init__(self, endpoint_url=None, bucket=None, prefix=None, part_size=None, part_workers=None):
+        self.endpoint_url = initconfig.S3_ENDPOINT_URL if endpoint_url is None else endpoint_url
+        self.bucket = initconfig.S3_BUCKET if bucket is None else bucket
+        self.prefix = initconfig.S3_PREFIX if prefix is None else prefix
+        self.part_size = initconfig.S3_PART_SIZE if part_size is None else part_size
+        self.part_workers = initconfig.S3_PART_WORKERS if part_workers is None else part_workers
+
+    def client(self):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise UploadError("Uploading to S3 needs boto3, install it with pip install boto3.")
+
+        # Missing keys fall back to boto3's own lookup (environment, ~/.aws...)
+        return boto3.session.Session().client(
+            "s3", endpoint_url=self.endpoint_url or None,
+            aws_access_key_id=initconfig.S3_ACCESS_KEY_ID or None,
+            aws_secret_access_key=initconfig.S3_SECRET_ACCESS_KEY or None,
+            config=Config(max_pool_connections=self.part_workers,
+                          retries={"max_attempts": 10, "mode": "standard"}))
+
+    def key(self, clip):
+        return self.prefix + os.path.basename(clip.clip_file_name)
+
+    def upload(self, client, clip, journal=None, log=print):
+        from boto3.exceptions import S3UploadFailedError
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        size = os.path.getsize(clip.clip_file_name)
+        config = TransferConfig(multipart_threshold=self.part_size, multipart_chunksize=self.part_size,
+                                max_concurrency=self.part_workers, use_threads=True)
+        key = self.key(clip)
+        bucket = upload_bucket()
+        log(f"Uploading file to s3://{self.bucket}/{key}...")
+
+        with stage("upload", size=size, backend=self.name) as event:
+            event["bytes"] = 0
+            lock = threading.Lock()
+
+            def progress(sent):
+                # Called from the part threads as they read what they send,
+                # blocking here throttles them. TransferConfig's max_bandwidth
+                # would only limit this upload, not the other upload workers.
+                with lock:
+                    event["bytes"] += sent
+                if bucket is not None and sent > 0:
+                    bucket.consume(sent)
+
+            try:
+                client.upload_file(clip.clip_file_name, self.bucket, key, Config=config, Callback=progress)
+            except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+                raise UploadError(f"Couldn't upload to s3://{self.bucket}/{key}: {e}")
+        log(f"Uploaded {format_bytes(size)} to s3://{self.bucket}/{key}.")
+        return {"bucket": self.bucket, "key": key}
+
+
+def get_upload_backend(name=None):
+    if name is None:
+        name = initconfig.UPLOAD_BACKEND
+    if name == "s3":
+        return S3Backend()
+    return YoutubeBackend()
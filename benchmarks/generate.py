@@ -0,0 +1,128 @@
+"""Synthetic inputs for the benchmarks: clips, clip libraries and watchlists.
+
+Can also be run on its own to keep the generated data around:
+
+    python benchmarks/generate.py clips out/clips
+    python benchmarks/generate.py library out/videos --clips 5000
+    python benchmarks/generate.py watchlist out/watchlist.txt --entries 100000 --library out/videos
+"""
+import argparse
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from media import run_ffmpeg  # noqa: E402
+
+# (height, fps) pairs recorded by ShadowPlay that the hot paths have to handle
+CLIP_FORMATS = ((1080, 60), (1080, 144), (1440, 60), (1440, 144))
+CLIP_DURATION = 10
+
+GAMES = ("Apex Legends", "Counter-strike Global Offensive", "Desktop", "Destiny 2",
+         "Fortnite", "Grand Theft Auto V", "League of Legends", "Minecraft",
+         "Overwatch", "Rocket League", "Valorant", "Warzone")
+
+# Must match helpers.read_watchlist_file
+ARG_SEPARATOR = " ---------- "
+
+
+def clip_name(game: str, index: int):
+    """NVIDIA names clips "<Game> <date> - <time>.DVR.mp4" inside a folder per game"""
+    day = 1 + index % 28
+    seconds = index * 37
+    return (f"{game} 2021.08.{day:02d} - {seconds // 3600 % 24:02d}.{seconds // 60 % 60:02d}."
+            f"{seconds % 60:02d}.{index % 100:02d}.DVR.mp4")
+
+
+def generate_clip(output: str, height: int, fps: int, duration=CLIP_DURATION):
+    """Encodes a test pattern with a tone, keyframes every 2 seconds like ShadowPlay"""
+    if os.path.exists(output):
+        return output
+
+    width = height * 16 // 9
+    tmp = output + ".part.mp4"
+    run_ffmpeg(["-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+                "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                "-g", f"{fps * 2}", "-c:a", "aac", "-shortest", tmp])
+    os.replace(tmp, output)
+    return output
+
+
+def generate_clips(folder: str, formats=CLIP_FORMATS, duration=CLIP_DURATION):
+    """Returns {(height, fps): path}, clips already generated are reused"""
+    os.makedirs(folder, exist_ok=True)
+    return {(height, fps): generate_clip(os.path.join(folder, f"{height}p{fps}.mp4"),
+                                         height, fps, duration)
+            for height, fps in formats}
+
+
+def generate_library(folder: str, clips: int, games=GAMES):
+    """Empty placeholder clips spread over one folder per game, returns their paths"""
+    paths = []
+    for i in range(clips):
+        game = games[i % len(games)]
+        game_folder = os.path.join(folder, game)
+        if i < len(games):
+            os.makedirs(game_folder, exist_ok=True)
+        path = os.path.join(game_folder, clip_name(game, i))
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        paths.append(path)
+    return paths
+
+
+def generate_watchlist(fname: str, entries: int, library=None, seed=0):
+    """Writes a text watchlist, entries past the library's clips point to missing files
+
+    Flags are random but seeded so every revision reads the same file.
+    """
+    rng = random.Random(seed)
+    root = os.path.abspath(library or os.path.dirname(fname))
+    existing = [] if library is None else sorted(
+        os.path.join(d, f) for d, _, files in os.walk(root) for f in files)
+
+    with open(fname, "w") as f:
+        for i in range(entries):
+            if i < len(existing):
+                path = existing[i]
+            else:
+                game = GAMES[i % len(GAMES)]
+                path = os.path.join(root, game, clip_name(game, i))
+            ignored = rng.random() < 0.3
+            archived = not ignored and rng.random() < 0.5
+            uploaded = not ignored and rng.random() < 0.2
+            f.write(ARG_SEPARATOR.join([path, str(int(ignored)), str(int(archived)),
+                                        str(int(uploaded))]) + "\n")
+    return fname
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic clips, clip libraries and watchlists.")
+    sub = parser.add_subparsers(dest="kind", required=True)
+
+    clips = sub.add_parser("clips", help="1080p/1440p test clips at 60 and 144 fps")
+    clips.add_argument("folder")
+    clips.add_argument("--duration", type=int, default=CLIP_DURATION)
+
+    library = sub.add_parser("library", help="NVIDIA style game folders of empty clips")
+    library.add_argument("folder")
+    library.add_argument("--clips", type=int, default=5000)
+
+    watchlist = sub.add_parser("watchlist", help="text watchlist file")
+    watchlist.add_argument("fname")
+    watchlist.add_argument("--entries", type=int, default=100000)
+    watchlist.add_argument("--library", help="folder whose clips the first entries point to")
+
+    args = parser.parse_args()
+    if args.kind == "clips":
+        for path in generate_clips(args.folder, duration=args.duration).values():
+            print(path)
+    elif args.kind == "library":
+        print(f"{len(generate_library(args.folder, args.clips))} clips in {args.folder}")
+    else:
+        generate_watchlist(args.fname, args.entries, library=args.library)
+        print(f"{args.entries} entries in {args.fname}")
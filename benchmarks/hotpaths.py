@@ -0,0 +1,202 @@
+"""Timings of the hot paths on synthetic data, saved as JSON to compare revisions.
+
+Run from the repository root (where config.ini lives), ffmpeg is needed to
+generate the clips:
+
+    python benchmarks/hotpaths.py [--output results.json] [--compare baseline.json]
+
+Generated data is kept in --workdir so later runs (and other revisions) reuse
+it. --quick skips the 1M entry watchlist and the 144 fps clips.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from generate import CLIP_FORMATS, generate_clips, generate_library, generate_watchlist  # noqa: E402
+from helpers import (WatchlistFile, YoutubeClip, get_videos_in_directory,  # noqa: E402
+                     read_watchlist_file, write_watchlist_file)
+
+WATCHLIST_SIZES = (1000, 100000, 1000000)
+LIBRARY_CLIPS = 5000
+
+# Clip settings for each mode, relative to a 10 second source
+CLIP_MODES = {"e": {"time_from": -5}, "s": {"time_from": 3},
+              "i": {"interval": (2, 7)}}
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(name: str, fn, runs: int, setup=None, **params):
+    """Median wall-clock time of fn over runs, the output of fn is discarded"""
+    times = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+
+    result = {"name": name, "params": params,
+              "seconds": statistics.median(times), "runs": times}
+    print(f"{name} {params}: {result['seconds']:.3f}s")
+    return result
+
+
+def remove(path: str):
+    return lambda: os.path.exists(path) and os.remove(path)
+
+
+def bench_watchlists(workdir: str, sizes, runs: int):
+    library = os.path.join(workdir, "library")
+    results = []
+    for size in sizes:
+        fname = os.path.join(workdir, f"watchlist_{size}.txt")
+        if not os.path.exists(fname):
+            generate_watchlist(fname, size, library=library)
+
+        # Memory held by the loaded watchlist, not what reading it peaks at
+        tracemalloc.start()
+        with quiet():
+            watchlist = read_watchlist_file(fname)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        output = os.path.join(workdir, "watchlist_out.txt")
+        results.append(measure("read_watchlist_file", lambda: read_watchlist_file(fname),
+                               runs, entries=size))
+        results[-1]["memory"] = memory
+        print(f"watchlist memory {{'entries': {size}}}: {memory / 1024 / 1024:.1f}MB")
+        results.append(measure("write_watchlist_file",
+                               lambda: write_watchlist_file(watchlist, verbose=False, fname=output),
+                               runs, entries=size))
+    return results
+
+
+def bench_scan(workdir: str, clips: int, runs: int):
+    library = os.path.join(workdir, "library")
+    cache_file = os.path.join(workdir, "scan_cache.json")
+    return [
+        measure("get_videos_in_directory",
+                lambda: get_videos_in_directory(library, cache_file=cache_file),
+                runs, setup=remove(cache_file), clips=clips, cache="cold"),
+        measure("get_videos_in_directory",
+                lambda: get_videos_in_directory(library, cache_file=cache_file),
+                runs, clips=clips, cache="warm"),
+    ]
+
+
+def bench_clips(workdir: str, formats, runs: int):
+    # nvdcu pulls in the CLI, only import it when it's needed
+    from nvdcu import archive_video
+
+    clips = generate_clips(os.path.join(workdir, "clips"), formats)
+    output = os.path.join(workdir, "out.mp4")
+    archive = os.path.join(workdir, "archive") + os.sep
+    os.makedirs(archive, exist_ok=True)
+
+    results = []
+    for (height, fps), source in clips.items():
+        for mode, settings in CLIP_MODES.items():
+            for smart_cut in (False, True):
+                clip = YoutubeClip(source, clip_mode=mode, smart_cut=smart_cut,
+                                   number_of_threads=os.cpu_count(), **settings)
+                clip.clip_file_name = output
+                results.append(measure("write_clip_file", clip.write_clip_file, runs,
+                                       setup=remove(output), height=height, fps=fps,
+                                       mode=mode, smart_cut=smart_cut))
+
+        f = WatchlistFile(source)
+        results.append(measure("archive_video",
+                               lambda: archive_video(f, folder=archive, threads=os.cpu_count()),
+                               runs, setup=remove(archive + f.filename), height=height, fps=fps))
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline: dict):
+    def key(r):
+        return r["name"], json.dumps(r["params"], sort_keys=True)
+
+    before = {key(r): r for r in baseline["results"]}
+    print(f"\nCompared to {baseline.get('revision')}:")
+    for r in results:
+        old = before.get(key(r))
+        if old and old["seconds"]:
+            print(f"{r['name']} {r['params']}: {old['seconds']:.3f}s -> {r['seconds']:.3f}s "
+                  f"({(r['seconds'] - old['seconds']) / old['seconds']:+.1%})")
+        if old and old.get("memory") and "memory" in r:
+            print(f"{r['name']} {r['params']} memory: {old['memory'] / 1024 / 1024:.1f}MB -> "
+                  f"{r['memory'] / 1024 / 1024:.1f}MB ({(r['memory'] - old['memory']) / old['memory']:+.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths on synthetic clips and watchlists.")
+    parser.add_argument("--workdir", default=os.path.join("benchmarks", "data"),
+                        help="where the generated data is kept")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results.json"))
+    parser.add_argument("--compare", help="results file of another revision")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="runs of the watchlist and scan benchmarks")
+    parser.add_argument("--clip-runs", type=int, default=1,
+                        help="runs of the clip and archive benchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the 1M entry watchlist and the 144 fps clips")
+    parser.add_argument("--no-clips", action="store_true",
+                        help="skip the benchmarks that need ffmpeg")
+    parser.add_argument("--clean", action="store_true",
+                        help="delete the generated data first")
+    args = parser.parse_args()
+
+    # Read first, the baseline may be the file we're about to overwrite
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    if args.clean and os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    os.makedirs(args.workdir, exist_ok=True)
+    generate_library(os.path.join(args.workdir, "library"), LIBRARY_CLIPS)
+
+    sizes = WATCHLIST_SIZES[:-1] if args.quick else WATCHLIST_SIZES
+    formats = [f for f in CLIP_FORMATS if f[1] <= 60] if args.quick else CLIP_FORMATS
+
+    results = bench_watchlists(args.workdir, sizes, args.runs)
+    results += bench_scan(args.workdir, LIBRARY_CLIPS, args.runs)
+    if not args.no_clips:
+        results += bench_clips(args.workdir, formats, args.clip_runs)
+
+    with open(args.output, "w") as f:
+        json.dump({"revision": revision(), "python": platform.python_version(),
+                   "platform": platform.platform(), "cpus": os.cpu_count(),
+                   "results": results}, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if baseline:
+        compare(results, baseline)
@@ -0,0 +1,202 @@
+"""Local S3-compatible stand-in, and a check that S3Backend uploads the parts of a clip in parallel.
+
+Run from the repository root (where config.ini lives):
+
+    python benchmarks/s3_standin.py [--size-mb 32] [--part-workers 4]
+
+The stand-in answers the calls boto3's upload_file makes on a path-style
+endpoint (PutObject and the multipart upload calls, like MinIO) and counts
+how many parts are in flight at once. A clip smaller than a part and one
+several parts long are uploaded through S3Backend, the check fails unless
+the bucket ends up with both clips byte for byte and the parts of the large
+one overlapped.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import initconfig  # noqa: E402
+from backends import S3Backend  # noqa: E402
+from quota import HeldClip  # noqa: E402
+
+MB = 1024 * 1024
+# S3 doesn't accept parts smaller than this, neither does S3Backend
+PART_SIZE = 5 * MB
+XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class S3Server(ThreadingHTTPServer):
+    """Buckets are created on first use, each part takes at least part_delay seconds
+
+    The delay stands in for the network, so parts that are sent in parallel
+    show up as overlapping requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, part_delay=0.2):
+        super().__init__(("127.0.0.1", 0), S3Handler)
+        self.part_delay = part_delay
+        self.objects = {}
+        self.uploads = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.parts = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_xml(self, body: str):
+        self.reply(200, f'<?xml version="1.0" encoding="UTF-8"?>\n{body}'.encode(),
+                   {"Content-Type": "application/xml"})
+
+    def target(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        return bucket, unquote(key), {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" not in self.headers.get("Content-Encoding", ""):
+            return body
+        # Chunks of "<hex size>[;chunk-signature=...]\r\n<data>\r\n", the
+        # checksum trailers after the last one are ignored
+        data = bytearray()
+        position = 0
+        while True:
+            end = body.index(b"\r\n", position)
+            size = int(body[position:end].split(b";")[0], 16)
+            if not size:
+                return bytes(data)
+            data += body[end + 2:end + 2 + size]
+            position = end + 2 + size + 2
+
+    def do_PUT(self):
+        bucket, key, query = self.target()
+        if "uploadId" not in query:
+            data = self.read_body()
+            self.server.objects[bucket, key] = data
+            return self.reply(200, headers={"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+        upload = self.server.uploads.get(query["uploadId"])
+        if upload is None:
+            return self.reply(404)
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.parts += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            data = self.read_body()
+            time.sleep(self.server.part_delay)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        upload[int(query["partNumber"])] = (etag, data)
+        self.reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        bucket, key, query = self.target()
+        if "uploads" in query:
+            self.read_body()
+            with self.server.lock:
+                upload_id = str(len(self.server.uploads))
+                self.server.uploads[upload_id] = {}
+            return self.reply_xml(
+                f'<InitiateMultipartUploadResult xmlns="{XMLNS}"><Bucket>{bucket}</Bucket>'
+                f'<Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+
+        upload = self.server.uploads.pop(query.get("uploadId"), None)
+        if upload is None:
+            return self.reply(404)
+        listed = self.read_body().decode()
+        numbers = [int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>", listed)]
+        if numbers != sorted(upload):
+            return self.reply(400)
+        self.server.objects[bucket, key] = b"".join(upload[n][1] for n in numbers)
+        self.reply_xml(
+            f'<CompleteMultipartUploadResult xmlns="{XMLNS}"><Location>{self.server.url}/{bucket}/{key}'
+            f'</Location><Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{len(numbers)}"</ETag>'
+            f'</CompleteMultipartUploadResult>')
+
+    def do_DELETE(self):
+        _, _, query = self.target()
+        self.server.uploads.pop(query.get("uploadId"), None)
+        self.reply(204)
+
+
+def check(backend: S3Backend, server: S3Server, size: int, workdir: str):
+    clip_file = os.path.join(workdir, f"clip_{size}.mp4")
+    content = os.urandom(size)
+    with open(clip_file, "wb") as f:
+        f.write(content)
+
+    server.max_in_flight = server.parts = 0
+    clip = HeldClip(clip_file, "source.mp4", "Stand-in", "S3 upload", "private")
+    start = time.perf_counter()
+    result = backend.upload(backend.client(), clip, log=lambda message: None)
+    elapsed = time.perf_counter() - start
+
+    if server.objects.get((result["bucket"], result["key"])) != content:
+        raise AssertionError(f"s3://{result['bucket']}/{result['key']} doesn't hold the clip.")
+    print(f"{size / MB:.1f}MB: {server.parts or 1} part(s), at most {server.max_in_flight or 1} "
+          f"in flight, {elapsed:.2f}s")
+    return server.parts, server.max_in_flight
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check S3Backend's multipart uploads against a local S3-compatible stand-in.")
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--part-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    server = S3Server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Any credentials and region do, the stand-in doesn't check signatures
+    initconfig.S3_ACCESS_KEY_ID = "standin"
+    initconfig.S3_SECRET_ACCESS_KEY = "standin"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    backend = S3Backend(endpoint_url=server.url, bucket="clips", prefix="standin/",
+                        part_size=PART_SIZE, part_workers=args.part_workers)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        parts, _ = check(backend, server, PART_SIZE // 2, workdir)
+        if parts:
+            raise AssertionError("A clip smaller than a part was sent as a multipart upload.")
+
+        size = args.size_mb * MB
+        parts, in_flight = check(backend, server, size, workdir)
+        if parts != -(-size // PART_SIZE):
+            raise AssertionError(f"Expected {-(-size // PART_SIZE)} parts, the stand-in got {parts}.")
+        if in_flight < min(args.part_workers, parts):
+            raise AssertionError(f"Only {in_flight} parts were in flight at once.")
+    server.shutdown()
+    print(f"Parts were uploaded {in_flight} at a time.")
@@ -0,0 +1,57 @@
+"""Startup time benchmark for the bookkeeping commands.
+
+Run from the repository root (where config.ini lives):
+
+    python benchmarks/startup.py [--runs 5] [--limit 1.0]
+
+Fails if importing nvdcu pulls in the media/API libraries or if the median
+wall-clock time of `nvdcu.py -s` goes over the limit (seconds).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Only the commands that use them should import these
+HEAVY_MODULES = ("moviepy", "numpy", "imageio", "apiclient",
+                 "googleapiclient", "oauth2client", "httplib2")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def heavy_imports():
+    code = ("import sys, nvdcu; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return [m for m in out.strip().split(",") if m]
+
+
+def time_command(args: list, runs: int):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "nvdcu.py"] + args, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark startup time of the bookkeeping commands.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--limit", type=float, default=1.0,
+                        help="maximum median time in seconds")
+    args = parser.parse_args()
+
+    heavy = heavy_imports()
+    if heavy:
+        exit(f"Importing nvdcu loaded heavy modules: {', '.join(heavy)}")
+
+    median = time_command(["-s"], args.runs)
+    print(f"nvdcu.py -s: {median:.3f}s (median of {args.runs} runs)")
+    if median > args.limit:
+        exit(f"Startup is over the {args.limit}s limit.")
@@ -0,0 +1,192 @@
+"""Local stand-in for YouTube's resumable upload protocol, and a check that uploads resume.
+
+Run from the repository root (where config.ini lives):
+
+    python benchmarks/youtube_standin.py [--size-mb 4]
+
+For both chunked and whole file uploads, the stand-in cuts the upload
+halfway through the clip and checks that the journal already holds the
+session URI at that point, as a run killed mid-upload would leave it. The
+upload is then resumed from the journal the way the next run would, and the
+check fails unless the server ends up with the whole clip and only the
+missing part was sent again.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import initconfig  # noqa: E402
+import upload  # noqa: E402
+from quota import HeldClip  # noqa: E402
+from upload import UploadError, UploadJournal, initialize_upload, resume_pending_uploads, upload_http  # noqa: E402
+
+UPLOAD_PATH = "/upload/youtube/v3/videos"
+SESSION_PATH = "/session/"
+
+
+class ResumableUploadServer(ThreadingHTTPServer):
+    """Sessions are started with a POST and filled with PUTs carrying Content-Range
+
+    The chunk that goes past drop_at bytes is cut there: the bytes before it
+    are kept and the server answers 503, like a connection that died
+    mid-chunk. on_drop is called first, while the client is still waiting on
+    the chunk, i.e. the state a run killed at that moment would leave behind.
+    """
+    daemon_threads = True
+
+    def __init__(self, drop_at=None, on_drop=None):
+        super().__init__(("127.0.0.1", 0), ResumableUploadHandler)
+        self.drop_at = drop_at
+        self.on_drop = on_drop
+        self.sessions = {}
+        self.received = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class ResumableUploadHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.startswith(UPLOAD_PATH):
+            return self.reply(404)
+        metadata = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.lock:
+            session = str(len(self.server.sessions))
+            self.server.sessions[session] = {"size": int(self.headers["X-Upload-Content-Length"]),
+                                             "data": bytearray(), "metadata": metadata}
+        self.reply(200, {"Location": self.server.url + SESSION_PATH + session})
+
+    def do_PUT(self):
+        session = self.server.sessions.get(self.path[len(SESSION_PATH):])
+        if session is None:
+            return self.reply(404)
+
+        length = int(self.headers.get("Content-Length", 0))
+        content_range = self.headers.get("Content-Range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", content_range)
+        if match:
+            start = int(match.group(1))
+            if start != len(session["data"]):
+                return self.reply(400)
+            chunk = self.rfile.read(length)
+            drop_at = self.server.drop_at
+            if drop_at is not None and start < drop_at < start + length:
+                self.server.drop_at = None
+                if self.server.on_drop:
+                    self.server.on_drop()
+                session["data"] += chunk[:drop_at - start]
+                self.server.received += drop_at - start
+                return self.reply(503)
+            session["data"] += chunk
+            self.server.received += length
+        else:
+            # "bytes */size" asks how much the session has
+            self.rfile.read(length)
+
+        if len(session["data"]) == session["size"]:
+            return self.reply(200, {"Content-Type": "application/json"},
+                              json.dumps({"id": "standin-" + self.path[len(SESSION_PATH):]}).encode())
+        headers = {"Range": f"bytes=0-{len(session['data']) - 1}"} if session["data"] else {}
+        self.reply(308, headers)
+
+
+class StandinService():
+    """The part of the YouTube service object upload.py uses, pointed at the stand-in"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._http = upload_http()
+
+    def videos(self):
+        return self
+
+    def insert(self, part, body, media_body):
+        from googleapiclient.http import HttpRequest
+        from googleapiclient.model import JsonModel
+
+        return HttpRequest(self._http, JsonModel().response,
+                           f"{self.url}{UPLOAD_PATH}?uploadType=resumable&part={part}",
+                           method="POST", body=json.dumps(body),
+                           headers={"content-type": "application/json"}, resumable=media_body)
+
+
+def check(size: int, chunk_size: int, workdir: str):
+    clip_file = os.path.join(workdir, f"clip_{chunk_size}.mp4")
+    content = os.urandom(size)
+    with open(clip_file, "wb") as f:
+        f.write(content)
+
+    journal_file = os.path.join(workdir, f"journal_{chunk_size}.json")
+    killed = {}
+
+    def on_drop():
+        killed.update(UploadJournal(journal_file).pending().get(clip_file, {}))
+
+    # Not on a chunk boundary, the chunk in flight is cut short
+    server = ResumableUploadServer(drop_at=size // 2 + 1000, on_drop=on_drop)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service = StandinService(server.url)
+    journal = UploadJournal(journal_file)
+    clip = HeldClip(clip_file, "source.mp4", "Stand-in", "Resumed upload", "private")
+
+    initconfig.UPLOAD_CHUNK_SIZE = chunk_size
+    try:
+        initialize_upload(service, clip, journal=journal, log=lambda message: None)
+        raise AssertionError("The stand-in didn't drop the upload.")
+    except UploadError:
+        pass
+    if not killed.get("uri"):
+        raise AssertionError(f"The session URI wasn't journaled during the chunk: {killed}")
+
+    sent_before = server.received
+    # What the next run does on startup
+    finished = resume_pending_uploads(service, journal)
+    session = next(iter(server.sessions.values()))
+    if finished != ["source.mp4"] or bytes(session["data"]) != content:
+        raise AssertionError("The resumed upload didn't complete the clip.")
+    if journal.pending():
+        raise AssertionError("The finished upload was left in the journal.")
+    resent = server.received - sent_before
+    print(f"{'whole file' if chunk_size < 0 else f'{chunk_size // 1024}KB chunks'}: "
+          f"dropped at {sent_before}/{size} bytes, resumed with {resent} bytes")
+    if sent_before + resent != size:
+        raise AssertionError("Part of the clip was sent twice.")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that interrupted uploads resume against a local stand-in server.")
+    parser.add_argument("--size-mb", type=int, default=4)
+    args = parser.parse_args()
+
+    # Fail on the first error instead of retrying, like a run that was killed
+    upload.MAX_RETRIES = 0
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as workdir:
+        # MediaFileUpload chunks are multiples of 256KB
+        check(size, 256 * 1024, workdir)
+        check(size, -1, workdir)
+    print("Uploads resumed from the server's offset.")
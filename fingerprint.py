@@ -0,0 +1,34 @@
+"""Cheap content fingerprints to match clips across renames, moves and duplicates."""
+import hashlib
+import os
+
+# A fingerprint hashes SAMPLE_COUNT blocks of SAMPLE_SIZE bytes at fixed
+# offsets spread over the file, so it costs a few KB of reads per clip
+SAMPLE_COUNT = 5
+SAMPLE_SIZE = 4096
+
+
+def file_fingerprint(filepath: str):
+    """Returns "<size>-<hash of sampled blocks>" for filepath"""
+    size = os.path.getsize(filepath)
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(filepath, "rb") as f:
+        if size <= SAMPLE_COUNT * SAMPLE_SIZE:
+            digest.update(f.read())
+        else:
+            step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            for i in range(SAMPLE_COUNT):
+                f.seek(i * step)
+                digest.update(f.read(SAMPLE_SIZE))
+
+    return f"{size}-{digest.hexdigest()}"
+
+
+def full_hash(filepath: str, block_size=1024 * 1024):
+    """Hash of the whole file, to tell byte-identical clips apart from near-identical ones"""
+    digest = hashlib.blake2b()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,33 +1,42 @@
 """Helper functions that can be used throughout the program."""
-from initconfig import DEFAULT_CLIP_MODE, DEFAULT_DESCRIPTION, DEFAULT_NUM_THREADS, DEFAULT_PRIVACY_STATUS, DEFAULT_TITLE, SAVE_CLIPS_TO, VIDEO_FOLDER
+import initconfig
 import os
 import sys
 import termtables as tt
 from colorama import Fore, Back, Style
-from moviepy.editor import VideoFileClip
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from upload import initialize_upload
-from apiclient.errors import HttpError
+from media import get_media_info, smart_cut
+from scanner import ClipScanner
+from instrument import stage
+
+# Folders listed at the same time when looking for missing watchlist files
+LIST_WORKERS = 16
+# Folders named in the missing files warning
+MISSING_FOLDERS_SHOWN = 5
 
 
 class YoutubeClip():
-    def __init__(self, clip=VideoFileClip, title=DEFAULT_TITLE, description=DEFAULT_DESCRIPTION, time_from=None, number_of_threads=DEFAULT_NUM_THREADS, privacy_status=DEFAULT_PRIVACY_STATUS, clip_file_name=None, clip_mode=DEFAULT_CLIP_MODE, interval=None):
-        self.title = title
-        self.description = description
+    def __init__(self, source: str, title=None, description=None, time_from=None, number_of_threads=None, privacy_status=None, clip_file_name=None, clip_mode=None, interval=None, smart_cut=None):
+        """Preferences left as None use the defaults in the config file"""
+        self.title = initconfig.DEFAULT_TITLE if title is None else title
+        self.description = initconfig.DEFAULT_DESCRIPTION if description is None else description
         self.time_from = time_from
         self.interval = interval
-        self.number_of_threads = number_of_threads
-        self.privacy_status = privacy_status
-        self.clip = clip
+        self.number_of_threads = initconfig.DEFAULT_NUM_THREADS if number_of_threads is None else number_of_threads
+        self.privacy_status = initconfig.DEFAULT_PRIVACY_STATUS if privacy_status is None else privacy_status
+        self.source = source  # path of the video this clip is cut from
+        self.smart_cut = initconfig.DEFAULT_SMART_CUT if smart_cut is None else smart_cut
 
         if clip_file_name:
             self.clip_file_name = clip_file_name
         else:
             self.clip_file_name = current_time()
 
-        self.clip_file_name = f"{SAVE_CLIPS_TO}{self.clip_file_name}"
+        self.clip_file_name = f"{initconfig.SAVE_CLIPS_TO}{self.clip_file_name}"
 
-        self.clip_mode = clip_mode
+        self.clip_mode = initconfig.DEFAULT_CLIP_MODE if clip_mode is None else clip_mode
 
         if self.clip_mode in "es" and self.time_from == None:
             raise Exception(
@@ -38,18 +47,38 @@ class YoutubeClip():
 
     def write_clip_file(self, fps=60):
         print(self.clip_mode)
+        start, end = self.clip_range()
+        with stage("encode", mode=self.clip_mode, smart_cut=self.smart_cut) as event:
+            event["frames"] = round((end - start) * fps)
+            self.encode(start, end, fps)
+            event["bytes"] = os.path.getsize(self.clip_file_name)
+
+    def encode(self, start: float, end: float, fps: int):
+        if self.smart_cut:
+            if smart_cut(self.source, self.clip_file_name, start, end, threads=self.number_of_threads):
+                return
+            print_warning(
+                "Smart cut isn't possible for this video, re-encoding the whole clip...")
+
+        from moviepy.editor import VideoFileClip
+
+        clip = VideoFileClip(self.source)
         if self.clip_mode in "es":
-            self.clip.subclip(self.time_from).write_videofile(self.clip_file_name, fps=fps,
-                                                              threads=self.number_of_threads)
+            clip.subclip(self.time_from).write_videofile(self.clip_file_name, fps=fps,
+                                                         threads=self.number_of_threads)
         elif self.clip_mode == 'i':
-            self.clip.subclip(self.interval[0], self.interval[1]).write_videofile(self.clip_file_name, fps=fps,
-                                                                                  threads=self.number_of_threads)
+            clip.subclip(self.interval[0], self.interval[1]).write_videofile(self.clip_file_name, fps=fps,
+                                                                             threads=self.number_of_threads)
+        clip.close()
 
-    def upload(self, auth_service):
-        try:
-            initialize_upload(youtube=auth_service, clip=self)
-        except HttpError as e:
-            print(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
+    def clip_range(self):
+        """(start, end) of the clip in seconds, same semantics as subclip"""
+        if self.clip_mode in "es":
+            duration = get_media_info(self.source).duration
+            if self.clip_mode == 'e':
+                return duration + self.time_from, duration
+            return self.time_from, duration
+        return self.interval[0], self.interval[1]
 
     def __str__(self):
         header = ["Preference", "Value"]
@@ -60,7 +89,8 @@ class YoutubeClip():
             ["Privacy Status", self.privacy_status],
             ["Num. Threads", self.number_of_threads],
             ["File Name", self.clip_file_name],
-            ["Clip Mode", self.clip_mode]
+            ["Clip Mode", self.clip_mode],
+            ["Smart Cut", self.smart_cut]
         ]
 
         if self.clip_mode in "es":
@@ -72,14 +102,80 @@ class YoutubeClip():
 
 
 class WatchlistFile():
-    def __init__(self, filepath, ignored=False, archived=False, uploaded=False, missing=False):
+    """A watchlist entry, kept small since watchlists can hold millions of them
+
+    The flags are packed into the bits of one int, relpath and filename are
+    derived from filepath when they're read.
+    """
+    __slots__ = ("watchlist", "filepath", "_flags", "_fingerprint")
+
+    # Bit of each flag in _flags
+    FLAG_BITS = {'ignored': 1, 'archived': 2, 'uploaded': 4, 'missing': 8}
+
+    def __init__(self, filepath, ignored=False, archived=False, uploaded=False, missing=False, fingerprint=None):
+        self.watchlist = None  # set when added to a watchlist, keeps its counters up to date
         self.filepath = filepath
-        self.relpath = os.path.relpath(filepath)
-        self.filename = os.path.basename(filepath)
-        self.ignored = ignored
-        self.archived = archived
-        self.uploaded = uploaded
-        self.missing = missing
+        self._flags = (ignored and 1) | (archived and 2) | (uploaded and 4) | (missing and 8)
+        self._fingerprint = fingerprint  # see fingerprint.file_fingerprint
+
+    @property
+    def relpath(self):
+        return os.path.relpath(self.filepath)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.filepath)
+
+    @property
+    def ignored(self):
+        return bool(self._flags & 1)
+
+    @ignored.setter
+    def ignored(self, value):
+        self._set_flag('ignored', value)
+
+    @property
+    def archived(self):
+        return bool(self._flags & 2)
+
+    @archived.setter
+    def archived(self, value):
+        self._set_flag('archived', value)
+
+    @property
+    def uploaded(self):
+        return bool(self._flags & 4)
+
+    @uploaded.setter
+    def uploaded(self, value):
+        self._set_flag('uploaded', value)
+
+    @property
+    def missing(self):
+        return bool(self._flags & 8)
+
+    @missing.setter
+    def missing(self, value):
+        self._set_flag('missing', value)
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        previous = self._fingerprint
+        self._fingerprint = value
+        if self.watchlist is not None and previous != value:
+            self.watchlist.fingerprint_changed(self, previous, value)
+
+    def _set_flag(self, flag: str, value: bool):
+        bit = self.FLAG_BITS[flag]
+        previous = bool(self._flags & bit)
+        value = bool(value)
+        self._flags = self._flags | bit if value else self._flags & ~bit
+        if self.watchlist is not None and previous != value:
+            self.watchlist.file_changed(self, flag, value)
 
     def __str__(self):
         data = [
@@ -94,66 +190,157 @@ class WatchlistFile():
 
 
 class Watchlist():
+    """Watchlist files indexed by absolute path and fingerprint"""
+    FLAGS = ('ignored', 'archived', 'uploaded', 'missing')
+
     def __init__(self, files=None):
         self.archived_count = 0
         self.uploaded_count = 0
         self.ignored_count = 0
-        self.files = []
+        self.missing_count = 0
+        self._by_path = {}  # path key -> file, keeps insertion order
+        self._by_fingerprint = {}  # fingerprint -> {path key: file}
+        self.store = None  # persists each change as it happens, see watchlist_store
         if files:
             for f in files:
                 assert type(f) == WatchlistFile
                 self.add_file(f)
 
+    @staticmethod
+    def path_key(filepath: str):
+        return os.path.normcase(os.path.abspath(filepath))
+
+    @property
+    def files(self):
+        return list(self._by_path.values())
+
     def nonmissing_files(self):
-        return filter(lambda f: f.missing == False, self.files)
+        return filter(lambda f: f.missing == False, self._by_path.values())
+
+    def find(self, filepath: str):
+        return self._by_path.get(self.path_key(filepath))
+
+    def find_by_fingerprint(self, fingerprint: str, include_missing=True):
+        files = self._by_fingerprint.get(fingerprint, {}).values()
+        return [f for f in files if include_missing or not f.missing]
 
     def add_file(self, f: WatchlistFile):
-        self.files.append(f)
+        key = self.path_key(f.filepath)
+        if key in self._by_path:
+            # Last entry for a path wins
+            self.remove_file(self._by_path[key])
+
+        self._index(f)
+        f.watchlist = self
         self.update_counters(f)
+        if self.store is not None:
+            self.store.file_added(f)
 
     def remove_file(self, f: WatchlistFile):
-        self.files.pop(self.files.index(f))
+        self._unindex(f)
+        f.watchlist = None
         self.update_counters(f, addition=False)
+        if self.store is not None:
+            self.store.file_removed(f)
+
+    def move_file(self, f: WatchlistFile, filepath: str):
+        """Points an entry at the new location of its clip"""
+        previous = f.filepath
+        self._unindex(f)
+        f.filepath = filepath
+        self._index(f)
+        if self.store is not None:
+            self.store.file_moved(f, previous)
+
+    def _index(self, f: WatchlistFile):
+        key = self.path_key(f.filepath)
+        self._by_path[key] = f
+        if f.fingerprint:
+            self._by_fingerprint.setdefault(f.fingerprint, {})[key] = f
+
+    def _unindex(self, f: WatchlistFile):
+        key = self.path_key(f.filepath)
+        del self._by_path[key]
+        self._discard(self._by_fingerprint, f.fingerprint, key)
+
+    @staticmethod
+    def _discard(index: dict, value, key: str):
+        entries = index.get(value)
+        if entries is not None:
+            entries.pop(key, None)
+            if not entries:
+                del index[value]
+
+    def remove_many(self, files):
+        for f in list(files):
+            self.remove_file(f)
+
+    def retain(self, predicate):
+        """Keeps only the files for which predicate(f) is true, returns the removed ones"""
+        removed = [f for f in self._by_path.values() if not predicate(f)]
+        self.remove_many(removed)
+        return removed
+
+    def flag_changed(self, f: WatchlistFile, flag: str, value: bool):
+        counter = f'{flag}_count'
+        setattr(self, counter, getattr(self, counter) + (1 if value else -1))
+
+    def fingerprint_changed(self, f: WatchlistFile, previous: str, value: str):
+        key = self.path_key(f.filepath)
+        self._discard(self._by_fingerprint, previous, key)
+        if value:
+            self._by_fingerprint.setdefault(value, {})[key] = f
+        if self.store is not None:
+            self.store.file_updated(f, 'fingerprint', value)
+
+    def file_changed(self, f: WatchlistFile, flag: str, value: bool):
+        self.flag_changed(f, flag, value)
+        if self.store is not None:
+            self.store.file_updated(f, flag, value)
 
     def update_counters(self, f: WatchlistFile, addition=True):
-        if addition:
-            if f.ignored:
-                self.ignored_count += 1
-            if f.archived:
-                self.archived_count += 1
-            if f.uploaded:
-                self.uploaded_count += 1
-        else:
-            if f.ignored:
-                self.ignored_count -= 1
-            if f.archived:
-                self.archived_count -= 1
-            if f.uploaded:
-                self.uploaded_count -= 1
+        for flag in self.FLAGS:
+            if getattr(f, flag):
+                self.flag_changed(f, flag, addition)
 
     def __str__(self):
-        if len(self.files) == 0:
+        if len(self) == 0:
             return ""
 
-        header = ["Filepath", "Ignored", "Archived", "Uploaded"]
+        header = ["Filepath", "Ignored", "Archived", "Uploaded", "Media"]
         data = []
-        for f in self.files:
-            data.append([f.filepath, f.ignored, f.archived, f.uploaded])
+        for f in self._by_path.values():
+            data.append([f.filepath, f.ignored, f.archived,
+                        f.uploaded, media_summary(f.filepath)])
 
-        stats = f"\nTotal: {len(self.files)} Ignored: {self.ignored_count} Archived: {self.archived_count} Uploaded: {self.uploaded_count}"
+        stats = f"\nTotal: {len(self)} Ignored: {self.ignored_count} Archived: {self.archived_count} Uploaded: {self.uploaded_count}"
         return tt.to_string(data, header=header) + stats
 
     def __sizeof__(self):
-        return len(self.files)
+        return len(self._by_path)
 
     def __len__(self):
-        return len(self.files)
+        return len(self._by_path)
 
 
-def input_interval(message: str, minimum=None, maximum=None, integer=True):
+def media_summary(filepath: str):
+    """Duration and resolution from the probe cache, empty if it was never probed"""
+    info = get_media_info(filepath, probe=False)
+    if info is None:
+        return ""
+    return f"{info.duration:.0f}s {info.width}x{info.height}@{info.fps:.0f}"
+
+
+def input_interval(message: str, minimum=None, maximum=None, integer=True, default=None):
+    message = f"[{minimum},{maximum}] " + message
+    if default != None:
+        message = f"[default={default[0]} {default[1]}] " + message
+
     invalid_input = True
     while invalid_input:
-        value = input(f"[{minimum},{maximum}] " + message)
+        value = input(message)
+        if default != None and value == '':
+            return tuple(default)
 
         try:
             interval = value.split(" ")
@@ -306,7 +493,9 @@ def input_range(message="Please insert a value: ", default=None, minimum=None, m
     return value
 
 
-def input_file(message: str, directory=VIDEO_FOLDER):
+def input_file(message: str, directory=None):
+    if directory is None:
+        directory = initconfig.VIDEO_FOLDER
     invalid_input = True
     while invalid_input:
         fname = input(
@@ -340,27 +529,61 @@ def current_time():
     return round(datetime.utcnow().timestamp() * 1000)
 
 
-def read_watchlist_file():
+def missing_files(paths):
+    """The paths that don't exist
+
+    Each folder is listed once, concurrently, instead of checking each file,
+    on a network share that's a round trip per folder instead of per file.
+    """
+    folders = {}
+    for path in paths:
+        folders.setdefault(os.path.dirname(path), []).append(path)
+    if not folders:
+        return set()
+
+    def listing(folder):
+        try:
+            return {os.path.normcase(name) for name in os.listdir(folder or os.curdir)}
+        except OSError:
+            return set()
+
+    with ThreadPoolExecutor(max_workers=min(LIST_WORKERS, len(folders))) as executor:
+        listings = dict(zip(folders, executor.map(listing, folders)))
+    return {path for folder, files in folders.items() for path in files
+            if os.path.normcase(os.path.basename(path)) not in listings[folder]}
+
+
+def warn_missing(missing):
+    """One warning for every missing file, grouped by folder"""
+    if not missing:
+        return
+    by_folder = Counter(os.path.dirname(path) for path in missing)
+    folders = ", ".join(f"{count} in {folder or os.curdir}" for folder,
+                        count in by_folder.most_common(MISSING_FOLDERS_SHOWN))
+    if len(by_folder) > MISSING_FOLDERS_SHOWN:
+        folders += f" and {len(by_folder) - MISSING_FOLDERS_SHOWN} more folders"
+    print_warning(f"Couldn't find {len(missing)} files ({folders}), they're marked as missing.")
+
+
+def read_watchlist_file(fname=None):
     print_info("Reading watchlist file...")
+    if fname is None:
+        fname = initconfig.WATCHLIST_FILE
 
     # We're dealing with filepaths, need exaggerated separators
-    fname = "watchlist.txt"
     arg_separator = " ---------- "  # - x 10
 
     files = Watchlist()
-    invalid_files = 0
+    entries = []
 
-    with open(fname, "r") as data_file:
+    with stage("watchlist_read") as event, open(fname, "r") as data_file:
         lines = list(filter(lambda line: len(line) > 0, data_file.readlines()))
 
         for line in lines:
-            f, ignored, archived, uploaded = line.split(sep=arg_separator)
-
-            missing = False
-            if not os.path.exists(f):
-                print_warning(f"Couldn't find file: {f}")
-                invalid_files += 1
-                missing = True
+            # Older watchlists don't have the fingerprint column
+            f, ignored, archived, uploaded, *fingerprint = line.rstrip(
+                "\n").split(sep=arg_separator)
+            fingerprint = fingerprint[0] if fingerprint and fingerprint[0] else None
 
             try:
                 archived = bool(int(archived))
@@ -371,48 +594,45 @@ def read_watchlist_file():
                     f"Error parsing watchlist file arguments! [f={f},i={ignored},a={archived},u={uploaded}]")
                 raise
 
+            entries.append((f, ignored, archived, uploaded, fingerprint))
+
+        missing = missing_files(entry[0] for entry in entries)
+        for f, ignored, archived, uploaded, fingerprint in entries:
             files.add_file(WatchlistFile(
-                f, ignored, archived, uploaded, missing))
+                f, ignored, archived, uploaded, f in missing, fingerprint))
 
-        data_file.seek(0)
+        event["entries"] = len(files)
+        event["missing"] = len(missing)
 
+    warn_missing(missing)
     print_info(
-        f"Successfully parsed watchlist file! {len(files)} files parsed. {invalid_files} files missing.")
+        f"Successfully parsed watchlist file! {len(files)} files parsed. {len(missing)} files missing.")
 
     return files
 
 
-def write_watchlist_file(watchlist: Watchlist):
-    print_info("Writing watchlist file...")
+def write_watchlist_file(watchlist: Watchlist, verbose=True, fname=None):
+    if verbose:
+        print_info("Writing watchlist file...")
+    if fname is None:
+        fname = initconfig.WATCHLIST_FILE
 
     arg_separator = " ---------- "  # - x 10
 
-    with open("watchlist.txt", "w+") as watchfile:
+    with open(fname, "w+") as watchfile:
         for f in watchlist.files:
-            line = f"{f.filepath}{arg_separator}{int(f.ignored)}{arg_separator}{int(f.archived)}{arg_separator}{int(f.uploaded)}\n"
+            line = f"{f.filepath}{arg_separator}{int(f.ignored)}{arg_separator}{int(f.archived)}{arg_separator}{int(f.uploaded)}{arg_separator}{f.fingerprint or ''}\n"
             watchfile.write(line)
 
-    print_info("Done.")
+    if verbose:
+        print_info("Done.")
 
 
-def get_videos_in_directory():
-    """Goes down to 2 levels recursively, since NVIDIA groups clips by game"""
-    videos = []
-    for folder, sub_folders, dir_files in os.walk(VIDEO_FOLDER):
-        for sub_folder in sub_folders:
-            for _, _, sub_files in os.walk(VIDEO_FOLDER + sub_folder):
-                for sub_file in sub_files:
-                    if sub_file[-4:] == '.mp4':
-                        incomplete = os.path.join(
-                            os.path.abspath(sub_folder), sub_file)
-                        filepath = os.path.join(
-                            os.path.abspath(folder), incomplete)
-                        dir_files.append((sub_file, filepath))
-
-        for f in dir_files:
-            if f[-4:] == '.mp4':
-                videos.append((f, os.path.join(os.path.abspath(folder), f)))
-
+def get_videos_in_directory(directory=None, changed_only=False, cache_file=None, save=True):
+    """Goes down to 2 levels, since NVIDIA groups clips by game, see ClipScanner"""
+    with stage("scan", changed_only=changed_only) as event:
+        videos = list(ClipScanner(directory, cache_file).scan(changed_only=changed_only, save=save))
+        event["clips"] = len(videos)
     return videos
 
 
@@ -427,11 +647,18 @@ def delete_video(f: WatchlistFile, watchlist: Watchlist):
         print_info("Successfully deleted the video.")
 
 
-def preview_video(f: WatchlistFile):
+def preview_video(f: WatchlistFile, previews=None):
+    """Opens the proxy or contact sheet from previews if there's one, the video otherwise"""
+    path = previews.get(f) if previews is not None else None
+    if path:
+        print_info("Opening the preview, the original video is opened if you preview it again.")
+    else:
+        path = f.filepath
+
     if sys.platform == 'linux':
-        os.system(f'xdg-open "{f.filepath}"')
+        os.system(f'xdg-open "{path}"')
     elif sys.platform == 'win32':
-        os.startfile(f.filepath)
+        os.startfile(path)
     else:
         raise Exception("Video preview isn't available in your OS.")
 
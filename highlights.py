@@ -0,0 +1,221 @@
+"""Suggests clip intervals from audio loudness and on-screen motion."""
+import atexit
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import initconfig
+from media import ffmpeg_command, get_media_info, save_json
+
+HIGHLIGHT_CACHE_FILE = "highlights.json"
+HIGHLIGHT_CACHE_ENTRIES = 5000
+# New entries are saved in batches of this many, and once at exit
+HIGHLIGHT_CACHE_SAVE_EVERY = 10
+
+# Scores are computed per window (seconds)
+WINDOW = 0.5
+# Length and number of the suggested intervals (seconds)
+SUGGESTION_LENGTH = 30
+SUGGESTIONS = 3
+
+# Decoded at a low rate/resolution, only loudness and motion are needed
+AUDIO_RATE = 8000
+FRAME_RATE = 4
+FRAME_WIDTH, FRAME_HEIGHT = 64, 36
+# Seconds of audio/frames read from ffmpeg at once, bounds the memory used
+CHUNK_SECONDS = 10
+
+# How much each score counts towards a window's score
+AUDIO_WEIGHT = 0.6
+MOTION_WEIGHT = 0.4
+
+
+def stream(args: list, chunk_size: int, popen=subprocess.Popen):
+    """Yields chunks of ffmpeg's raw output, the last one may be shorter
+
+    popen starts ffmpeg, e.g PreviewWorker.popen so the analysis can be
+    terminated. A terminated or failed ffmpeg raises CalledProcessError
+    instead of passing for the end of the clip.
+    """
+    cmd = ffmpeg_command(args + ["-"])
+    process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def audio_energy(source: str, popen=subprocess.Popen):
+    """RMS of each window of the first audio track, mixed down to mono"""
+    import numpy as np
+
+    window = int(AUDIO_RATE * WINDOW)
+    energy = []
+    leftover = np.empty(0, dtype=np.float32)
+    for chunk in stream(["-i", source, "-vn", "-ac", "1", "-ar", f"{AUDIO_RATE}", "-f", "s16le"],
+                        AUDIO_RATE * CHUNK_SECONDS * 2, popen):
+        samples = np.concatenate(
+            [leftover, np.frombuffer(chunk[:len(chunk) // 2 * 2], dtype=np.int16).astype(np.float32)])
+        full = len(samples) // window * window
+        windows = samples[:full].reshape(-1, window)
+        energy.append(np.sqrt(np.mean(windows ** 2, axis=1)))
+        leftover = samples[full:]
+
+    if len(leftover):
+        energy.append(np.sqrt(np.mean(leftover ** 2, keepdims=True)))
+    return np.concatenate(energy) if energy else np.empty(0, dtype=np.float32)
+
+
+def motion(source: str, popen=subprocess.Popen):
+    """Mean absolute difference between consecutive grayscale frames, per window"""
+    import numpy as np
+
+    frame_size = FRAME_WIDTH * FRAME_HEIGHT
+    frames_per_window = FRAME_RATE * WINDOW
+    diffs = []
+    previous = None
+    for chunk in stream(["-i", source, "-an", "-vf",
+                         f"fps={FRAME_RATE},scale={FRAME_WIDTH}:{FRAME_HEIGHT},format=gray",
+                         "-f", "rawvideo"], frame_size * FRAME_RATE * CHUNK_SECONDS, popen):
+        frames = np.frombuffer(chunk[:len(chunk) // frame_size * frame_size],
+                               dtype=np.uint8).reshape(-1, frame_size).astype(np.int16)
+        if previous is not None:
+            frames = np.concatenate([previous, frames])
+        if len(frames) > 1:
+            diffs.append(np.mean(np.abs(np.diff(frames, axis=0)), axis=1))
+        previous = frames[-1:]
+
+    if not diffs:
+        return np.empty(0, dtype=np.float32)
+    diffs = np.concatenate(diffs)
+    # The first frame has nothing to be compared with
+    diffs = np.concatenate([diffs[:1], diffs])
+    windows = np.floor(np.arange(len(diffs)) / frames_per_window).astype(int)
+    return np.bincount(windows, weights=diffs) / np.bincount(windows)
+
+
+def normalize(scores):
+    import numpy as np
+
+    if not len(scores):
+        return scores
+    spread = np.std(scores)
+    return (scores - np.median(scores)) / spread if spread else np.zeros_like(scores)
+
+
+def rank_intervals(scores, duration: float, length=SUGGESTION_LENGTH, count=SUGGESTIONS):
+    """Best non overlapping [start, end, score] intervals of length seconds"""
+    import numpy as np
+
+    if not len(scores):
+        return []
+    span = max(1, min(len(scores), int(round(length / WINDOW))))
+    totals = np.convolve(scores, np.ones(span), mode="valid") / span
+
+    intervals = []
+    for _ in range(count):
+        best = int(np.argmax(totals))
+        # Past the first, only intervals that stand out from the rest of the clip
+        if not np.isfinite(totals[best]) or intervals and totals[best] <= 0:
+            break
+        start = best * WINDOW
+        intervals.append([round(start, 2), round(min(start + span * WINDOW, duration), 2),
+                          round(float(totals[best]), 3)])
+        # Overlapping intervals can't be picked again
+        totals[max(0, best - span + 1):best + span] = -np.inf
+    return intervals
+
+
+def find_highlights(source: str, popen=subprocess.Popen):
+    """Suggested [start, end, score] intervals of source, the best one first, see stream for popen"""
+    import numpy as np
+
+    info = get_media_info(source)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio = executor.submit(audio_energy, source, popen) if info.audio_codecs else None
+        video = executor.submit(motion, source, popen)
+        audio = audio.result() if audio else np.empty(0)
+        video = video.result()
+
+    windows = max(len(audio), len(video))
+    if not windows:
+        return []
+    scores = np.zeros(windows)
+    scores[:len(audio)] += AUDIO_WEIGHT * normalize(audio)
+    scores[:len(video)] += MOTION_WEIGHT * normalize(video)
+    return rank_intervals(scores, info.duration)
+
+
+class HighlightCache():
+    """Suggestions persisted on disk, keyed by (path, size, mtime) like media.ProbeCache"""
+
+    def __init__(self, fname=None, max_entries=HIGHLIGHT_CACHE_ENTRIES, save_every=HIGHLIGHT_CACHE_SAVE_EVERY):
+        if fname is None:
+            fname = os.path.join(initconfig.CACHE_FOLDER, HIGHLIGHT_CACHE_FILE)
+        self.fname = fname
+        self.max_entries = max_entries
+        self.save_every = save_every
+        # Entries added since the last save
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        try:
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        save_json(self.fname, self.entries)
+        self.unsaved = 0
+
+    def flush(self):
+        """Saves the entries added since the last save"""
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+    def get(self, filepath: str, analyze=True, popen=subprocess.Popen):
+        """Returns the suggestions for filepath, None if they aren't cached and analyze is False"""
+        st = os.stat(filepath)
+        key = os.path.abspath(filepath)
+        stamp = [st.st_size, st.st_mtime_ns]
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["stat"] == stamp:
+                return entry["intervals"]
+        if not analyze:
+            return None
+
+        intervals = find_highlights(filepath, popen)
+        with self.lock:
+            # Dicts keep insertion order, the oldest entries go first
+            self.entries.pop(key, None)
+            self.entries[key] = {"stat": stamp, "intervals": intervals}
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+        return intervals
+
+
+_highlight_cache = None
+
+
+def get_highlights(filepath: str, analyze=True, popen=subprocess.Popen):
+    """Shared HighlightCache lookup, see HighlightCache.get"""
+    global _highlight_cache
+    if _highlight_cache is None:
+        _highlight_cache = HighlightCache()
+        atexit.register(_highlight_cache.flush)
+    return _highlight_cache.get(filepath, analyze=analyze, popen=popen)
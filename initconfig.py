@@ -1,7 +1,56 @@
 import configparser
+from os import makedirs
 from os.path import exists
 from multiprocessing import cpu_count
 
+# Options added after the first config.ini, so a config.ini from an older
+# version keeps working without being edited. Its own values take precedence.
+DEFAULTS = {
+    'Clipping Defaults': {
+        'ENCODE_WORKERS': '1',
+        'DEFAULT_SMART_CUT': 'yes',
+    },
+    'Directories': {
+        'CACHE_FOLDER': 'cache',
+    },
+    'Watchlist': {
+        'WATCHLIST_BACKEND': 'text',
+        'WATCHLIST_FILE': 'watchlist.txt',
+        'WATCHLIST_DATABASE': 'watchlist.db',
+    },
+    'Upload': {
+        'UPLOAD_BACKEND': 'youtube',
+        'UPLOAD_CHUNK_SIZE_MB': '8',
+        'UPLOAD_BANDWIDTH_LIMIT_KBPS': '0',
+        'UPLOAD_WORKERS': '2',
+        'PIPELINE_QUEUE_SIZE': '2',
+        'UPLOAD_DAILY_QUOTA': '10000',
+        'UPLOAD_QUOTA_COST': '1600',
+    },
+    'S3': {
+        'S3_ENDPOINT_URL': '',
+        'S3_BUCKET': 'clips',
+        'S3_PREFIX': '',
+        'S3_ACCESS_KEY_ID': '',
+        'S3_SECRET_ACCESS_KEY': '',
+        'S3_PART_SIZE_MB': '16',
+        'S3_PART_WORKERS': '8',
+    },
+    'Batch': {
+        'RULES_FILE': 'rules.ini',
+    },
+    'Previews': {
+        'PREVIEW_WORKERS': '1',
+        'PREVIEW_CACHE_SIZE_MB': '2048',
+        'PREVIEW_HEIGHT': '360',
+        'PREVIEW_THUMBNAILS': '12',
+    },
+    'Watch': {
+        'WATCH_STABLE_SECONDS': '10',
+        'WATCH_POLL_SECONDS': '2',
+    },
+}
+
 
 class Configuration():
     def __init__(self):
@@ -9,9 +58,16 @@ class Configuration():
         self.CLIP_SECTION = 'Clipping Defaults'
         self.DIR_SECTION = 'Directories'
         self.ARCH_SECTION = 'Archival'
+        self.WATCHLIST_SECTION = 'Watchlist'
+        self.UPLOAD_SECTION = 'Upload'
+        self.BATCH_SECTION = 'Batch'
+        self.PREVIEW_SECTION = 'Previews'
+        self.WATCH_SECTION = 'Watch'
+        self.S3_SECTION = 'S3'
         self.CONFIG_FILE = 'config.ini'
 
         config = configparser.ConfigParser()
+        config.read_dict(DEFAULTS)
         config.read(self.CONFIG_FILE)
 
         self.config = config
@@ -19,6 +75,12 @@ class Configuration():
         self.clipping = config.options(self.CLIP_SECTION)
         self.directories = config.options(self.DIR_SECTION)
         self.archival = config.options(self.ARCH_SECTION)
+        self.watchlist = config.options(self.WATCHLIST_SECTION)
+        self.upload = config.options(self.UPLOAD_SECTION)
+        self.batch = config.options(self.BATCH_SECTION)
+        self.previews = config.options(self.PREVIEW_SECTION)
+        self.watch = config.options(self.WATCH_SECTION)
+        self.s3 = config.options(self.S3_SECTION)
 
     def api_client_secrets(self):
         return self.get_option(self.API_SECTION, 'client_secrets_file', path=True)
@@ -56,6 +118,16 @@ class Configuration():
                 f'Invalid value ({opt}) for default_privacy_status in section {self.CLIP_SECTION} in {self.CONFIG_FILE}.')
         return opt
 
+    def def_smart_cut(self):
+        opt = self.get_option(self.CLIP_SECTION, 'default_smart_cut')
+        try:
+            opt = self.config.getboolean(self.CLIP_SECTION, 'default_smart_cut')
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for default_smart_cut in section {self.CLIP_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
     def def_title(self):
         return self.get_option(self.CLIP_SECTION, 'default_title')
 
@@ -74,6 +146,11 @@ class Configuration():
     def dir_archive(self):
         return self.get_option(self.DIR_SECTION, 'archive_folder', path=True)
 
+    def dir_cache(self):
+        opt = self.get_option(self.DIR_SECTION, 'cache_folder')
+        makedirs(opt, exist_ok=True)
+        return opt
+
     def arch_fps(self):
         opt = self.get_option(self.ARCH_SECTION, 'compress_fps')
         try:
@@ -94,6 +171,210 @@ class Configuration():
         else:
             return opt
 
+    def watchlist_backend(self):
+        opt = self.get_option(self.WATCHLIST_SECTION, 'watchlist_backend')
+        if not opt in ['text', 'sqlite']:
+            raise Exception(
+                f'Invalid value ({opt}) for watchlist_backend in section {self.WATCHLIST_SECTION} in {self.CONFIG_FILE}.')
+        return opt
+
+    def watchlist_file(self):
+        return self.get_option(self.WATCHLIST_SECTION, 'watchlist_file')
+
+    def watchlist_database(self):
+        return self.get_option(self.WATCHLIST_SECTION, 'watchlist_database')
+
+    def upload_backend(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_backend')
+        if not opt in ['youtube', 's3']:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_backend in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        return opt
+
+    def upload_chunk_size(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_chunk_size_mb')
+        try:
+            opt = int(opt)
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_chunk_size_mb in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            # MediaFileUpload takes bytes, -1 sends the whole file in one request
+            return opt * 1024 * 1024 if opt > 0 else -1
+
+    def upload_bandwidth_limit(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_bandwidth_limit_kbps')
+        try:
+            opt = int(opt)
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_bandwidth_limit_kbps in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            # bytes per second, 0 disables the limit
+            return max(opt, 0) * 1024
+
+    def upload_workers(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_workers')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_workers in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def encode_workers(self):
+        opt = self.get_option(self.CLIP_SECTION, 'encode_workers')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for encode_workers in section {self.CLIP_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def pipeline_queue_size(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'pipeline_queue_size')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for pipeline_queue_size in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def upload_daily_quota(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_daily_quota')
+        try:
+            opt = int(opt)
+            assert opt >= 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_daily_quota in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def upload_quota_cost(self):
+        opt = self.get_option(self.UPLOAD_SECTION, 'upload_quota_cost')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for upload_quota_cost in section {self.UPLOAD_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def batch_rules_file(self):
+        return self.get_option(self.BATCH_SECTION, 'rules_file')
+
+    def preview_workers(self):
+        opt = self.get_option(self.PREVIEW_SECTION, 'preview_workers')
+        try:
+            opt = int(opt)
+            assert opt >= 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for preview_workers in section {self.PREVIEW_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def preview_cache_size(self):
+        opt = self.get_option(self.PREVIEW_SECTION, 'preview_cache_size_mb')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for preview_cache_size_mb in section {self.PREVIEW_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt * 1024 * 1024
+
+    def preview_height(self):
+        opt = self.get_option(self.PREVIEW_SECTION, 'preview_height')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for preview_height in section {self.PREVIEW_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def preview_thumbnails(self):
+        opt = self.get_option(self.PREVIEW_SECTION, 'preview_thumbnails')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for preview_thumbnails in section {self.PREVIEW_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def watch_stable_seconds(self):
+        opt = self.get_option(self.WATCH_SECTION, 'watch_stable_seconds')
+        try:
+            opt = float(opt)
+            assert opt >= 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for watch_stable_seconds in section {self.WATCH_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def watch_poll_seconds(self):
+        opt = self.get_option(self.WATCH_SECTION, 'watch_poll_seconds')
+        try:
+            opt = float(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for watch_poll_seconds in section {self.WATCH_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
+    def s3_endpoint_url(self):
+        return self.get_option(self.S3_SECTION, 's3_endpoint_url')
+
+    def s3_bucket(self):
+        return self.get_option(self.S3_SECTION, 's3_bucket')
+
+    def s3_prefix(self):
+        return self.get_option(self.S3_SECTION, 's3_prefix')
+
+    def s3_access_key_id(self):
+        return self.get_option(self.S3_SECTION, 's3_access_key_id')
+
+    def s3_secret_access_key(self):
+        return self.get_option(self.S3_SECTION, 's3_secret_access_key')
+
+    def s3_part_size(self):
+        opt = self.get_option(self.S3_SECTION, 's3_part_size_mb')
+        try:
+            opt = int(opt)
+            # S3 doesn't accept parts smaller than 5MB
+            assert opt >= 5
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for s3_part_size_mb in section {self.S3_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt * 1024 * 1024
+
+    def s3_part_workers(self):
+        opt = self.get_option(self.S3_SECTION, 's3_part_workers')
+        try:
+            opt = int(opt)
+            assert opt > 0
+        except:
+            raise Exception(
+                f'Invalid value ({opt}) for s3_part_workers in section {self.S3_SECTION} in {self.CONFIG_FILE}.')
+        else:
+            return opt
+
     def get_option(self, section: str, option: str, path=False):
         if not self.config.has_option(section, option):
             raise Exception(
@@ -107,26 +388,81 @@ class Configuration():
         return opt
 
 
-CONFIG = Configuration()
+MAX_THREADS = cpu_count()
+VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
 
-CLIENT_SECRETS_FILE = CONFIG.api_client_secrets()
-YOUTUBE_UPLOAD_SCOPE = CONFIG.api_upload_scope()
-YOUTUBE_API_SERVICE_NAME = CONFIG.api_service_name()
-YOUTUBE_API_VERSION = CONFIG.api_version()
+# Options are read and validated the first time they're accessed, e.g
+# initconfig.VIDEO_FOLDER, so each command only pays for the options it uses
+OPTIONS = {
+    'CLIENT_SECRETS_FILE': Configuration.api_client_secrets,
+    'YOUTUBE_UPLOAD_SCOPE': Configuration.api_upload_scope,
+    'YOUTUBE_API_SERVICE_NAME': Configuration.api_service_name,
+    'YOUTUBE_API_VERSION': Configuration.api_version,
 
-DEFAULT_CLIP_MODE = CONFIG.def_clip_mode()
-DEFAULT_NUM_THREADS = CONFIG.def_num_threads()
-DEFAULT_PRIVACY_STATUS = CONFIG.def_privacy_status()
-DEFAULT_TITLE = CONFIG.def_title()
-DEFAULT_DESCRIPTION = CONFIG.def_description()
-DEFAULT_TAGS = CONFIG.def_tags()
+    'DEFAULT_CLIP_MODE': Configuration.def_clip_mode,
+    'DEFAULT_NUM_THREADS': Configuration.def_num_threads,
+    'DEFAULT_PRIVACY_STATUS': Configuration.def_privacy_status,
+    'DEFAULT_SMART_CUT': Configuration.def_smart_cut,
+    'DEFAULT_TITLE': Configuration.def_title,
+    'DEFAULT_DESCRIPTION': Configuration.def_description,
+    'DEFAULT_TAGS': Configuration.def_tags,
 
-SAVE_CLIPS_TO = CONFIG.dir_clips()
-VIDEO_FOLDER = CONFIG.dir_videos()
-ARCHIVE_FOLDER = CONFIG.dir_archive()
+    'SAVE_CLIPS_TO': Configuration.dir_clips,
+    'VIDEO_FOLDER': Configuration.dir_videos,
+    'ARCHIVE_FOLDER': Configuration.dir_archive,
+    'CACHE_FOLDER': Configuration.dir_cache,
 
-COMPRESS_FPS = CONFIG.arch_fps()
-COMPRESS_RES_HEIGHT = CONFIG.arch_res_height()
+    'WATCHLIST_BACKEND': Configuration.watchlist_backend,
+    'WATCHLIST_FILE': Configuration.watchlist_file,
+    'WATCHLIST_DATABASE': Configuration.watchlist_database,
 
-MAX_THREADS = cpu_count()
-VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
+    'UPLOAD_BACKEND': Configuration.upload_backend,
+    'UPLOAD_CHUNK_SIZE': Configuration.upload_chunk_size,
+    'UPLOAD_BANDWIDTH_LIMIT': Configuration.upload_bandwidth_limit,
+    'UPLOAD_WORKERS': Configuration.upload_workers,
+    'ENCODE_WORKERS': Configuration.encode_workers,
+    'PIPELINE_QUEUE_SIZE': Configuration.pipeline_queue_size,
+    'UPLOAD_DAILY_QUOTA': Configuration.upload_daily_quota,
+    'UPLOAD_QUOTA_COST': Configuration.upload_quota_cost,
+
+    'S3_ENDPOINT_URL': Configuration.s3_endpoint_url,
+    'S3_BUCKET': Configuration.s3_bucket,
+    'S3_PREFIX': Configuration.s3_prefix,
+    'S3_ACCESS_KEY_ID': Configuration.s3_access_key_id,
+    'S3_SECRET_ACCESS_KEY': Configuration.s3_secret_access_key,
+    'S3_PART_SIZE': Configuration.s3_part_size,
+    'S3_PART_WORKERS': Configuration.s3_part_workers,
+
+    'RULES_FILE': Configuration.batch_rules_file,
+
+    'PREVIEW_WORKERS': Configuration.preview_workers,
+    'PREVIEW_CACHE_SIZE': Configuration.preview_cache_size,
+    'PREVIEW_HEIGHT': Configuration.preview_height,
+    'PREVIEW_THUMBNAILS': Configuration.preview_thumbnails,
+
+    'WATCH_STABLE_SECONDS': Configuration.watch_stable_seconds,
+    'WATCH_POLL_SECONDS': Configuration.watch_poll_seconds,
+
+    'COMPRESS_FPS': Configuration.arch_fps,
+    'COMPRESS_RES_HEIGHT': Configuration.arch_res_height,
+}
+
+_config = None
+
+
+def get_config():
+    global _config
+    if _config is None:
+        _config = Configuration()
+    return _config
+
+
+def __getattr__(name: str):
+    if name == 'CONFIG':
+        return get_config()
+    if name not in OPTIONS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = OPTIONS[name](get_config())
+    globals()[name] = value
+    return value
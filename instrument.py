@@ -0,0 +1,114 @@
+"""Per-stage timings written as JSON lines, with a summary of where the time went."""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Summary columns, summed over the events of each stage
+COUNTERS = ("bytes", "frames", "retries")
+
+
+class Recorder():
+    """Collects stage events and appends them to a JSON lines file
+
+    Events look like {"stage": "encode", "start": <epoch>, "seconds": 1.5,
+    "thread": "MainThread", "frames": 600, ...}, stages that raised also
+    carry "error" with the exception name.
+    """
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.events = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.file = open(fname, "a") if fname else None
+
+    def record(self, event: dict):
+        with self.lock:
+            self.events.append(event)
+            if self.file:
+                self.file.write(json.dumps(event) + "\n")
+                self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        """Table of the time, bytes/s and frames/s of each stage against the wall clock"""
+        import termtables as tt
+
+        wall = time.perf_counter() - self.started
+        stages = {}
+        with self.lock:
+            for event in self.events:
+                totals = stages.setdefault(event["stage"], dict.fromkeys(
+                    ("count", "seconds", "errors") + COUNTERS, 0))
+                totals["count"] += 1
+                totals["seconds"] += event["seconds"]
+                totals["errors"] += "error" in event
+                for counter in COUNTERS:
+                    totals[counter] += event.get(counter, 0)
+
+        if not stages:
+            return f"Nothing was recorded in {wall:.2f}s."
+
+        def rate(amount, seconds, unit):
+            return f"{amount / seconds:.1f} {unit}/s" if amount and seconds else ""
+
+        header = ["Stage", "Count", "Time", "% of wall", "Bytes/s", "Frames/s",
+                  "Retries", "Errors"]
+        data = [[name, t["count"], f"{t['seconds']:.2f}s", f"{t['seconds'] / wall:.1%}",
+                 rate(t["bytes"] / 1024 / 1024, t["seconds"], "MB"),
+                 rate(t["frames"], t["seconds"], "frames"), t["retries"], t["errors"]]
+                for name, t in sorted(stages.items(), key=lambda s: -s[1]["seconds"])]
+
+        # Encoding and uploading overlap, so the percentages can add up past 100%
+        return tt.to_string(data, header=header) + f"\nWall clock: {wall:.2f}s"
+
+
+_recorder = None
+
+
+def enable(fname=None):
+    """Starts recording, events are also appended to fname if given"""
+    global _recorder
+    _recorder = Recorder(fname)
+    return _recorder
+
+
+def recorder():
+    return _recorder
+
+
+def record(name: str, seconds: float, **fields):
+    """Records an event timed elsewhere, like in a worker process"""
+    if _recorder is None:
+        return
+    _recorder.record({"stage": name, "start": time.time() - seconds, "seconds": seconds,
+                      "thread": threading.current_thread().name, **fields})
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """Times the block as one event, the block can add counters to the yielded dict
+
+    Does nothing beyond yielding a dict when recording isn't enabled.
+    """
+    event = dict(fields)
+    if _recorder is None:
+        yield event
+        return
+
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        event["error"] = type(e).__name__
+        raise
+    finally:
+        _recorder.record({"stage": name, "start": start,
+                          "seconds": time.perf_counter() - started,
+                          "thread": threading.current_thread().name, **event})
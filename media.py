@@ -0,0 +1,339 @@
+"""Thin wrappers around the ffmpeg/ffprobe binaries used for probing and stream level operations."""
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+import initconfig
+from instrument import stage
+
+# Containers and codecs whose bitstream can be copied and concatenated with
+# re-encoded segments, codec name maps to the encoder used for the edges.
+SMART_CUT_CONTAINERS = ("mov", "mp4")
+SMART_CUT_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
+# Edges shorter than this are dropped instead of re-encoded (seconds)
+SMART_CUT_EPSILON = 0.01
+
+PROBE_CACHE_FILE = "probe_cache.json"
+# Least recently used entries are evicted past this size
+PROBE_CACHE_ENTRIES = 20000
+# New entries are saved in batches of this many, and once at exit
+PROBE_CACHE_SAVE_EVERY = 100
+
+MediaInfo = namedtuple("MediaInfo", ["duration", "fps", "width", "height",
+                                     "video_codec", "audio_codecs"])
+
+# An output of render(), start/end cut it (seconds) and height/fps scale it down
+RenderOutput = namedtuple("RenderOutput", ["path", "start", "end", "height", "fps"],
+                          defaults=(None, None, None, None))
+
+
+def ffmpeg_binary():
+    from moviepy.config import get_setting
+
+    return get_setting("FFMPEG_BINARY")
+
+
+def ffprobe_binary():
+    """ffprobe is not shipped with moviepy, look next to ffmpeg and then in PATH"""
+    ffmpeg = ffmpeg_binary()
+    name = "ffprobe.exe" if ffmpeg.endswith(".exe") else "ffprobe"
+    sibling = os.path.join(os.path.dirname(ffmpeg), name)
+    if os.path.dirname(ffmpeg) and os.path.exists(sibling):
+        return sibling
+    return shutil.which("ffprobe")
+
+
+def ffmpeg_command(args: list):
+    return [ffmpeg_binary(), "-hide_banner", "-loglevel", "error", "-y"] + args
+
+
+def run_ffmpeg(args: list):
+    subprocess.run(ffmpeg_command(args), check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.PIPE)
+
+
+def run_ffprobe(args: list):
+    ffprobe = ffprobe_binary()
+    if not ffprobe:
+        raise FileNotFoundError("Couldn't find the ffprobe binary.")
+
+    cmd = [ffprobe, "-v", "error"] + args
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def probe_video_stream(filepath: str):
+    """Returns the first video stream's entries merged with the format's"""
+    out = run_ffprobe(["-select_streams", "v:0",
+                       "-show_entries", "stream=codec_name,pix_fmt,time_base",
+                       "-show_entries", "format=format_name,duration",
+                       "-of", "json", filepath])
+    data = json.loads(out)
+    if not data.get("streams"):
+        raise ValueError(f"No video stream found in {filepath}")
+
+    info = dict(data["streams"][0])
+    info.update(data.get("format", {}))
+    return info
+
+
+def probe_media(filepath: str):
+    """Reads container metadata only, no frames are decoded"""
+    try:
+        out = run_ffprobe(["-show_entries", "format=duration",
+                           "-show_entries", "stream=codec_type,codec_name,width,height,avg_frame_rate",
+                           "-of", "json", filepath])
+    except FileNotFoundError:
+        return parse_ffmpeg_infos(filepath)
+
+    data = json.loads(out)
+    video = next((s for s in data.get("streams", [])
+                 if s.get("codec_type") == "video"), {})
+    audio = [s.get("codec_name") for s in data.get("streams", [])
+             if s.get("codec_type") == "audio"]
+
+    num, _, den = video.get("avg_frame_rate", "0/1").partition("/")
+    fps = float(num) / float(den) if den and float(den) else float(num or 0)
+    return MediaInfo(duration=float(data.get("format", {}).get("duration", 0)), fps=fps,
+                     width=video.get("width", 0), height=video.get("height", 0),
+                     video_codec=video.get("codec_name"), audio_codecs=audio)
+
+
+def parse_ffmpeg_infos(filepath: str):
+    """Fallback for when ffprobe isn't available, parses `ffmpeg -i` instead"""
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+    infos = ffmpeg_parse_infos(filepath)
+    width, height = infos.get("video_size", (0, 0))
+    return MediaInfo(duration=infos.get("duration", 0), fps=infos.get("video_fps", 0),
+                     width=width, height=height, video_codec=None,
+                     audio_codecs=[None] if infos.get("audio_found") else [])
+
+
+def save_json(fname: str, data):
+    """Writes data to fname atomically
+
+    The temporary file is unique, archive workers are separate processes
+    that save the same caches at the same time.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or os.curdir,
+                               prefix=os.path.basename(fname) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ProbeCache():
+    """Probed metadata persisted on disk, keyed by (path, size, mtime) with LRU eviction"""
+
+    def __init__(self, fname=None, max_entries=PROBE_CACHE_ENTRIES, save_every=PROBE_CACHE_SAVE_EVERY):
+        if fname is None:
+            fname = os.path.join(initconfig.CACHE_FOLDER, PROBE_CACHE_FILE)
+        self.fname = fname
+        self.max_entries = max_entries
+        self.save_every = save_every
+        # Entries added since the last save
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        try:
+            with open(fname, "r") as f:
+                self.entries = OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            self.entries = OrderedDict()
+
+    def save(self):
+        save_json(self.fname, list(self.entries.items()))
+        self.unsaved = 0
+
+    def flush(self):
+        """Saves the entries added since the last save"""
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+    def get(self, filepath: str, probe=True):
+        """Returns the MediaInfo for filepath, None if it isn't cached and probe is False"""
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        key = os.path.abspath(filepath)
+        stamp = [st.st_size, st.st_mtime_ns]
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["stat"] == stamp:
+                self.entries.move_to_end(key)
+                return MediaInfo(*entry["info"])
+
+        if not probe:
+            return None
+
+        with stage("probe"):
+            info = probe_media(filepath)
+        with self.lock:
+            self.entries[key] = {"stat": stamp, "info": list(info)}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            # Rewriting the whole cache after each probe would make a first
+            # scan quadratic
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+        return info
+
+
+_probe_cache = None
+
+
+def get_media_info(filepath: str, probe=True):
+    """Shared ProbeCache lookup, see ProbeCache.get"""
+    global _probe_cache
+    if _probe_cache is None:
+        _probe_cache = ProbeCache()
+        atexit.register(_probe_cache.flush)
+    return _probe_cache.get(filepath, probe=probe)
+
+
+def flush_probe_cache():
+    """Saves what the shared ProbeCache hasn't yet, worker processes don't run atexit"""
+    if _probe_cache is not None:
+        _probe_cache.flush()
+
+
+def render(source: str, outputs: list, threads=1):
+    """Renders every RenderOutput of source from a single decode of it
+
+    The decoded stream is split in a filter graph, each branch is trimmed and
+    scaled for its output, so cutting clips and archiving the same recording
+    costs one decode instead of one per output.
+    """
+    has_audio = bool(get_media_info(source).audio_codecs)
+    labels = range(len(outputs))
+
+    graph = ["[0:v]split=%d%s" % (len(outputs), "".join(f"[v{i}]" for i in labels))]
+    if has_audio:
+        graph.append("[0:a]asplit=%d%s" % (len(outputs), "".join(f"[a{i}]" for i in labels)))
+
+    maps = []
+    for i, output in zip(labels, outputs):
+        video = [f"[v{i}]"]
+        audio = [f"[a{i}]"]
+        if output.start is not None or output.end is not None:
+            trim = ":".join(f"{k}={v}" for k, v in (("start", output.start), ("end", output.end))
+                            if v is not None)
+            video.append(f"trim={trim},setpts=PTS-STARTPTS")
+            audio.append(f"atrim={trim},asetpts=PTS-STARTPTS")
+        if output.height:
+            video.append(f"scale=-2:{int(output.height)}")
+        if output.fps:
+            video.append(f"fps={output.fps}")
+
+        graph.append(video[0] + (",".join(video[1:]) or "null") + f"[vo{i}]")
+        maps += ["-map", f"[vo{i}]"]
+        if has_audio:
+            graph.append(audio[0] + (",".join(audio[1:]) or "anull") + f"[ao{i}]")
+            maps += ["-map", f"[ao{i}]"]
+        maps += ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac",
+                 "-threads", f"{threads}", "-f", "mp4", output.path]
+
+    run_ffmpeg(["-i", source, "-filter_complex", ";".join(graph)] + maps)
+
+
+def keyframe_times(filepath: str):
+    """Presentation times of the video keyframes, read from packet flags without decoding"""
+    out = run_ffprobe(["-select_streams", "v:0",
+                       "-show_entries", "packet=pts_time,flags",
+                       "-of", "csv=p=0", filepath])
+    times = []
+    for line in out.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def smart_cut(source: str, output: str, start: float, end: float, threads=1):
+    """Cuts [start, end) from source re-encoding only the partial GOPs at each edge
+
+    The GOPs fully inside the cut are copied as a bitstream, the edges are
+    re-encoded with the same codec and the audio is re-encoded over the whole
+    range (cheap compared to video). The source frame rate is kept.
+
+    Returns
+    -------
+    bool
+        False if the codec/container doesn't allow it or ffmpeg failed, the
+        caller is expected to fall back to a full re-encode
+    """
+    try:
+        info = probe_video_stream(source)
+        keyframes = keyframe_times(source)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return False
+
+    containers = info.get("format_name", "").split(",")
+    encoder = SMART_CUT_ENCODERS.get(info.get("codec_name"))
+    if not encoder or not any(c in SMART_CUT_CONTAINERS for c in containers):
+        return False
+
+    # Copyable range spans from the first keyframe inside the cut to the last one
+    inner = [k for k in keyframes if start <= k <= end]
+    if len(inner) < 2:
+        return False
+    copy_from, copy_to = inner[0], inner[-1]
+
+    # MPEG-TS carries parameter sets in-band, so segments from different
+    # encoders can be concatenated without mismatched extradata
+    with tempfile.TemporaryDirectory() as tmp:
+        segments = []
+
+        def encode_edge(seg_start, seg_end):
+            path = os.path.join(tmp, f"{len(segments)}.ts")
+            run_ffmpeg(["-ss", f"{seg_start}", "-i", source, "-t", f"{seg_end - seg_start}",
+                        "-map", "0:v:0", "-an", "-c:v", encoder,
+                        "-pix_fmt", info.get("pix_fmt", "yuv420p"),
+                        "-threads", f"{threads}", path])
+            segments.append(path)
+
+        try:
+            if copy_from - start > SMART_CUT_EPSILON:
+                encode_edge(start, copy_from)
+
+            path = os.path.join(tmp, f"{len(segments)}.ts")
+            run_ffmpeg(["-ss", f"{copy_from}", "-i", source, "-t", f"{copy_to - copy_from}",
+                        "-map", "0:v:0", "-an", "-c", "copy", path])
+            segments.append(path)
+
+            if end - copy_to > SMART_CUT_EPSILON:
+                encode_edge(copy_to, end)
+
+            concat_list = os.path.join(tmp, "segments.txt")
+            with open(concat_list, "w") as f:
+                for segment in segments:
+                    f.write(f"file '{segment}'\n")
+
+            video = os.path.join(tmp, "video.mp4")
+            run_ffmpeg(["-f", "concat", "-safe", "0", "-i", concat_list,
+                        "-c", "copy", video])
+
+            run_ffmpeg(["-i", video, "-ss", f"{start}", "-t", f"{end - start}", "-i", source,
+                        "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac",
+                        "-shortest", output])
+        except subprocess.CalledProcessError:
+            if os.path.exists(output):
+                os.remove(output)
+            return False
+
+    return True
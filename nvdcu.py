@@ -1,14 +1,41 @@
 import argparse
+import atexit
+import json
 import os
-from moviepy.editor import VideoFileClip
-from initconfig import DEFAULT_NUM_THREADS, COMPRESS_FPS, COMPRESS_RES_HEIGHT, ARCHIVE_FOLDER, MAX_THREADS, VALID_PRIVACY_STATUSES
-from helpers import input_interval, input_selection, input_range, YoutubeClip, print_info, read_watchlist_file, write_watchlist_file, Watchlist, WatchlistFile, get_videos_in_directory, delete_video, preview_video
-from upload import get_authenticated_service
+import time
+import termtables as tt
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import initconfig
+import instrument
+from initconfig import MAX_THREADS, VALID_PRIVACY_STATUSES
+from helpers import input_interval, input_selection, input_range, YoutubeClip, print_info, Watchlist, WatchlistFile, get_videos_in_directory, delete_video, preview_video, print_error, print_warning
+from upload import UploadJournal, format_bytes
+from backends import get_upload_backend
+from fingerprint import file_fingerprint, full_hash
+from media import RenderOutput, flush_probe_cache, get_media_info, probe_media, render
+from scheduler import ClipPipeline
+from quota import QuotaLedger
+from watchlist_store import WatchlistStore, open_watchlist_store
+from rules import ClipFacts, Rules
+from previews import PreviewWorker
+from watcher import ClipWatcher
+from highlights import get_highlights
+
+PROFILE_FILE = "profile.jsonl"
+ARCHIVE_CHECKPOINT_FILE = "archive_checkpoint.json"
+
+# Archives are written to "<name>.part.mp4" and renamed once verified
+PARTIAL_SUFFIX = ".part.mp4"
+# Difference allowed between the archived and the source duration (seconds)
+ARCHIVE_DURATION_TOLERANCE = 1.0
+
+PlannedClip = namedtuple("PlannedClip", ["clip", "rule", "action"])
 
 
 def get_clip_preferences(filepath: str):
 
-    vdf_clip = VideoFileClip(filepath)
+    duration = get_media_info(filepath).duration
 
     title = input("Insert the title for the clip: ")
     if not title:
@@ -18,36 +45,40 @@ def get_clip_preferences(filepath: str):
     if not description:
         description = 'Default description.\n\nUploaded with nvdcu.py :)'
 
+    # Loud and busy moments are offered as the default interval
+    suggestions = suggest_highlights(filepath)
+
     # get clipping mode [from (e)nd,from (s)tart,(i)nterval]
     options = {"s": "from start, e.g first 10 seconds",
                "e": "from end, e.g last 10 seconds", "i": "time interval"}
     message = "Select clipping mode: "
     mode = input_selection(
-        options=options, message=message, default='e')
+        options=options, message=message, default='i' if suggestions else 'e')
 
     # get time starting from the end (last 5 seconds)
-    error = f"The clip's duration is {vdf_clip.duration}s, please insert a valid float.\n"
+    error = f"The clip's duration is {duration}s, please insert a valid float.\n"
     t = None
     interval = None
     if mode == 'e':
         message = "Time in seconds from the end: "
         t = -input_range(message=message,
-                         minimum=0, maximum=vdf_clip.duration, integer=False, errors=(None, None, error))
+                         minimum=0, maximum=duration, integer=False, errors=(None, None, error))
     elif mode == 's':
         message = "Time in seconds from the start: "
         t = input_range(message=message,
-                        minimum=0, maximum=vdf_clip.duration, integer=False, errors=(None, None, error))
+                        minimum=0, maximum=duration, integer=False, errors=(None, None, error))
     elif mode == 'i':
         message = "Please input an interval (e.g 55 135):"
         interval = input_interval(
-            message, minimum=0, maximum=vdf_clip.duration, integer=False)
+            message, minimum=0, maximum=duration, integer=False,
+            default=suggestions[0][:2] if suggestions else None)
     else:
         raise Exception(f"Invalid clip mode accepted ({mode})")
 
     # get number of threads to be used in the creation of the clip
     error = f"The maximum number of threads allowed is {MAX_THREADS}, please insert a valid integer.\n"
     thread_number = input_range(message="Number of threads used to process clip: ",
-                                minimum=1, maximum=MAX_THREADS, default=DEFAULT_NUM_THREADS, errors=(None, None, error))
+                                minimum=1, maximum=MAX_THREADS, default=initconfig.DEFAULT_NUM_THREADS, errors=(None, None, error))
 
     # get video's privacy status [(un)listed,(pu)blic,(pr)rivate]
     options = {op[0:2]: op for op in VALID_PRIVACY_STATUSES}
@@ -55,47 +86,501 @@ def get_clip_preferences(filepath: str):
     privacy_status = options[input_selection(
         options=options, message=message, default='un')]
 
-    clip = YoutubeClip(vdf_clip, title=title, description=description, time_from=t, interval=interval, clip_mode=mode,
+    clip = YoutubeClip(filepath, title=title, description=description, time_from=t, interval=interval, clip_mode=mode,
                        number_of_threads=thread_number, privacy_status=privacy_status, clip_file_name=title+".mp4")
     print(clip)
 
     return clip
 
 
-def archive_uploaded(force=False, folder=ARCHIVE_FOLDER):
-    print_info("Archiving uploaded files...")
-    watchlist = read_watchlist_file()
+def get_more_intervals(clip: YoutubeClip):
+    """Other intervals cut from the same video, uploaded as clips with the same preferences"""
+    duration = get_media_info(clip.source).duration
+    # The suggestions are cached by now, the next ones are offered in turn
+    suggestions = get_highlights(clip.source, analyze=False) or []
 
-    for f in watchlist.files:
-        if not f.missing:
-            if force or f.uploaded and not f.archived:
-                archive_video(f, ARCHIVE_FOLDER)
+    clips = []
+    options = {"y": "yes", "n": "no"}
+    while input_selection(options, "Cut another interval from this video? ", default="n") == "y":
+        suggestion = suggestions[len(clips) + 1] if len(clips) + 1 < len(suggestions) else None
+        interval = input_interval(
+            "Please input an interval (e.g 55 135):", minimum=0, maximum=duration, integer=False,
+            default=suggestion[:2] if suggestion else None)
+        title = f"{clip.title} ({len(clips) + 2})"
+        clips.append(YoutubeClip(clip.source, title=title, description=clip.description, interval=interval,
+                                 clip_mode="i", number_of_threads=clip.number_of_threads,
+                                 privacy_status=clip.privacy_status, clip_file_name=title + ".mp4",
+                                 smart_cut=clip.smart_cut))
+    return clips
+
+
+def suggest_highlights(filepath: str):
+    """Prints the suggested intervals of the clip, best first, see highlights.py
+
+    Only suggests what PreviewWorker already worked out, analysing the whole
+    clip here would hold up the prompt.
+    """
+    try:
+        suggestions = get_highlights(filepath, analyze=False)
+    except Exception as e:
+        print_warning(f"Couldn't look for highlights in this video: {e}")
+        return []
+    if suggestions is None:
+        print_info("Highlights of this video aren't ready yet.")
+        return []
+
+    if suggestions:
+        data = [[i, start, end, score]
+                for i, (start, end, score) in enumerate(suggestions, start=1)]
+        print_info("Suggested intervals:")
+        tt.print(data, header=["#", "From", "To", "Score"])
+    return suggestions
+
+
+def archive_uploaded(force=False, folder=None, jobs=1, store=None):
+    print_info("Archiving uploaded files...")
+    if folder is None:
+        folder = initconfig.ARCHIVE_FOLDER
+    if store is None:
+        store = open_watchlist_store()
+    watchlist = store.load()
+
+    remove_partial_archives(folder)
+
+    # Clips finished by an interrupted run aren't archived again, even with force
+    checkpoint = ArchiveCheckpoint(folder)
+    pending = [f for f in watchlist.files if not f.missing and (
+        force or f.uploaded and not f.archived) and f.filepath not in checkpoint.done]
+    if checkpoint.done:
+        print_info(
+            f"Resuming an interrupted run, {len(checkpoint.done)} videos were already archived.")
+
+    if jobs > 1 and len(pending) > 1:
+        failed = archive_parallel(
+            pending, watchlist, store, folder, jobs, checkpoint=checkpoint)
+    else:
+        failed = 0
+        for f in pending:
+            try:
+                archive_video(f, folder)
+            except Exception as e:
+                failed += 1
+                print_error(f"Failed archiving video {f.filepath}: {e}")
+                continue
+            # Keep finished work if the batch is cut short
+            store.save(watchlist, verbose=False)
+            checkpoint.mark(f.filepath)
+
+    # Failed videos are retried by the next run, the rest is skipped
+    if not failed:
+        checkpoint.finish()
 
     # Update watchlist file
-    write_watchlist_file(watchlist)
-
-
-def archive_video(f: WatchlistFile, folder=ARCHIVE_FOLDER):
+    store.save(watchlist)
+
+
+def archive_parallel(files: list, watchlist: Watchlist, store: WatchlistStore, folder: str, jobs=1, checkpoint=None):
+    """Archives files across a process pool, jobs x threads stays within MAX_THREADS
+
+    Returns the number of videos that failed.
+    """
+    jobs = max(1, min(jobs, MAX_THREADS, len(files)))
+    threads = max(1, MAX_THREADS // jobs)
+    print_info(
+        f"Archiving {len(files)} videos with {jobs} jobs ({threads} threads each)...")
+
+    start = time.time()
+    archived = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(archive_job, f.filepath, folder + f.filename, threads): f
+                   for f in files}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                f = futures[future]
+                try:
+                    job_time = future.result()
+                except Exception as e:
+                    failed += 1
+                    print_error(f"Failed archiving video {f.filepath}: {e}")
+                else:
+                    archived += 1
+                    f.archived = True
+                    store.save(watchlist, verbose=False)
+                    if checkpoint is not None:
+                        checkpoint.mark(f.filepath)
+                    instrument.record("archive", job_time, **archive_counters(f.filepath))
+                    print_info(
+                        f"Archived video: {f.filename} ({job_time:.1f}s)")
+
+                elapsed = time.time() - start
+                eta = elapsed / done * (len(files) - done)
+                print_info(
+                    f"[{done}/{len(files)}] {archived} archived, {failed} failed, {elapsed:.0f}s elapsed, ETA {eta:.0f}s")
+        except KeyboardInterrupt:
+            print_warning(
+                "Interrupted, cancelling pending archive jobs...")
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            store.save(watchlist, verbose=False)
+
+    return failed
+
+
+def archive_job(filepath: str, output: str, threads: int):
+    """Runs in a worker process, returns the time it took to archive"""
+    start = time.time()
+    print_info(f"Archiving video: {filepath}")
+    try:
+        compress_video(filepath, output, threads=threads, verbose=False)
+    finally:
+        flush_probe_cache()
+    return time.time() - start
+
+
+def archive_video(f: WatchlistFile, folder=None, threads=None):
     print_info(f"Archiving video: {f.filepath}")
+    if folder is None:
+        folder = initconfig.ARCHIVE_FOLDER
 
-    vdf = VideoFileClip(f.filepath)
-    print("Before:", vdf.filename, vdf.fps, vdf.size)
+    with instrument.stage("archive") as event:
+        compress_video(f.filepath, folder + f.filename, threads=threads)
+        event.update(archive_counters(f.filepath))
 
-    if (vdf.size[1] > COMPRESS_RES_HEIGHT):
-        vdf = vdf.resize(height=COMPRESS_RES_HEIGHT)
+    f.archived = True
 
-    if (vdf.fps > COMPRESS_FPS):
-        vdf = vdf.set_fps(COMPRESS_FPS)
 
-    print("After:", vdf.filename, vdf.fps, vdf.size, "\n")
+def render_clips(f: WatchlistFile, clips: list, archive=False, folder=None):
+    """Writes every clip of f, and its archive if archive is True, from a single decode of f
+
+    Doesn't mark f as archived, it may run in an encode worker, see
+    ClipPipeline.submit_many.
+    """
+    outputs = [RenderOutput(clip.clip_file_name, *clip.clip_range()) for clip in clips]
+    threads = clips[0].number_of_threads if clips else initconfig.DEFAULT_NUM_THREADS
+
+    if archive:
+        if folder is None:
+            folder = initconfig.ARCHIVE_FOLDER
+        info = get_media_info(f.filepath)
+        output = folder + f.filename
+        partial = os.path.splitext(output)[0] + PARTIAL_SUFFIX
+        outputs.append(RenderOutput(
+            partial, height=initconfig.COMPRESS_RES_HEIGHT if info.height > initconfig.COMPRESS_RES_HEIGHT else None,
+            fps=initconfig.COMPRESS_FPS if info.fps > initconfig.COMPRESS_FPS else None))
+
+    print_info(f"Rendering {len(outputs)} outputs of {f.filename} in a single pass...")
+    with instrument.stage("render", outputs=len(outputs), archive=archive) as event:
+        try:
+            render(f.filepath, outputs, threads=threads)
+            if archive:
+                verify_archive(f.filepath, partial)
+        except BaseException:
+            if archive and os.path.exists(partial):
+                os.remove(partial)
+            raise
+        if archive:
+            os.replace(partial, output)
+        event["bytes"] = os.path.getsize(f.filepath)
+
+
+def archive_counters(filepath: str):
+    """Frames written and source bytes read when archiving filepath"""
+    info = get_media_info(filepath)
+    fps = min(info.fps, initconfig.COMPRESS_FPS)
+    return {"frames": round(info.duration * fps), "bytes": os.path.getsize(filepath)}
+
+
+def compress_video(filepath: str, output: str, threads=None, verbose=True):
+    from moviepy.editor import VideoFileClip
+
+    if threads is None:
+        threads = initconfig.DEFAULT_NUM_THREADS
+
+    info = get_media_info(filepath)
+    if verbose:
+        print("Before:", filepath, info.fps, [info.width, info.height])
+
+    vdf = VideoFileClip(filepath)
+    if (info.height > initconfig.COMPRESS_RES_HEIGHT):
+        vdf = vdf.resize(height=initconfig.COMPRESS_RES_HEIGHT)
+
+    if (info.fps > initconfig.COMPRESS_FPS):
+        vdf = vdf.set_fps(initconfig.COMPRESS_FPS)
+
+    if verbose:
+        print("After:", vdf.filename, vdf.fps, vdf.size, "\n")
+
+    # Only a verified archive gets the final name, a crash leaves a .part file
+    partial = os.path.splitext(output)[0] + PARTIAL_SUFFIX
+    try:
+        try:
+            vdf.write_videofile(partial, threads=threads,
+                                logger='bar' if verbose else None)
+        finally:
+            vdf.close()
+        verify_archive(filepath, partial)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, output)
+
+
+def verify_archive(source: str, output: str):
+    """Checks that output is a readable video as long as source"""
+    expected = get_media_info(source).duration
+    try:
+        info = probe_media(output)
+    except Exception as e:
+        raise Exception(f"Couldn't read the archived video {output}: {e}")
+
+    if not info.width or abs(info.duration - expected) > ARCHIVE_DURATION_TOLERANCE:
+        raise Exception(
+            f"The archived video {output} is {info.duration}s long, expected {expected}s.")
+
+
+def remove_partial_archives(folder: str):
+    """Deletes the .part files left by archive jobs that were cut short"""
+    partials = [os.path.join(folder, name) for name in os.listdir(folder)
+                if name.endswith(PARTIAL_SUFFIX)]
+    for partial in partials:
+        os.remove(partial)
+    if partials:
+        print_warning(
+            f"Removed {len(partials)} partially archived videos left by an interrupted run.")
+
+
+class ArchiveCheckpoint():
+    """Videos archived so far by an archive run, kept until the run finishes
+
+    The checkpoint belongs to an archive folder, a run into another folder
+    starts from scratch.
+    """
+
+    def __init__(self, folder: str, fname=None):
+        if fname is None:
+            fname = os.path.join(initconfig.CACHE_FOLDER, ARCHIVE_CHECKPOINT_FILE)
+        self.fname = fname
+        self.folder = os.path.abspath(folder)
+        try:
+            with open(fname, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+
+        self.done = set(data.get("done", [])) if data.get(
+            "folder") == self.folder else set()
+
+    def save(self):
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"folder": self.folder, "done": sorted(self.done)}, f, indent=1)
+        os.replace(tmp, self.fname)
+
+    def mark(self, filepath: str):
+        self.done.add(filepath)
+        self.save()
+
+    def finish(self):
+        self.done = set()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+def print_profile(recorder: instrument.Recorder):
+    recorder.close()
+    print_info("Time spent in each stage:")
+    print(recorder.summary())
+    print_info(f"Events were written to {recorder.fname}")
+
+
+def match_video(watchlist: Watchlist, filepath: str):
+    """Finds the watchlist entry for a clip on disk, adding one if it's new
+
+    Entries are matched by path and then by fingerprint, so a clip that was
+    moved or renamed keeps its entry instead of being triaged again.
+    """
+    f = watchlist.find(filepath)
+    if f:
+        if f.fingerprint is None:
+            f.fingerprint = file_fingerprint(filepath)
+        return f
+
+    fingerprint = file_fingerprint(filepath)
+    moved = [c for c in watchlist.find_by_fingerprint(fingerprint) if c.missing]
+    if moved:
+        f = moved[0]
+        print_info(f"Video was moved: {f.filepath} -> {filepath}")
+        watchlist.move_file(f, filepath)
+        f.missing = False
+        return f
+
+    f = WatchlistFile(filepath, fingerprint=fingerprint)
+    watchlist.add_file(f)
+    return f
+
+
+def dedupe_report(watchlist: Watchlist):
+    """Prints the clips that share a fingerprint and the space that could be reclaimed"""
+    print_info("Looking for duplicate videos...")
+
+    groups = {}
+    for _, filepath in get_videos_in_directory():
+        f = watchlist.find(filepath)
+        if f and f.fingerprint is None:
+            f.fingerprint = file_fingerprint(filepath)
+        fingerprint = f.fingerprint if f else file_fingerprint(filepath)
+        groups.setdefault(fingerprint, []).append(filepath)
+
+    header = ["Group", "Filepath", "Match", "Size"]
+    data = []
+    reclaimable = 0
+    near_reclaimable = 0
+    duplicates = [paths for paths in groups.values() if len(paths) > 1]
+    for group, paths in enumerate(duplicates, start=1):
+        size = os.path.getsize(paths[0])
+
+        # Same samples doesn't mean same bytes, compare whole files within a group
+        by_hash = {}
+        for filepath in paths:
+            by_hash.setdefault(full_hash(filepath), []).append(filepath)
+
+        for identical in by_hash.values():
+            match = "identical" if len(identical) > 1 else "near-identical"
+            reclaimable += size * (len(identical) - 1)
+            for filepath in identical:
+                data.append([group, filepath, match, format_bytes(size)])
+        near_reclaimable += size * (len(by_hash) - 1)
+
+    if not data:
+        print_info("No duplicate videos found.")
+        return
+
+    tt.print(data, header=header)
+    print_info(
+        f"{len(duplicates)} groups of duplicates. {format_bytes(reclaimable)} reclaimable from identical videos, {format_bytes(near_reclaimable)} more from near-identical ones.")
+
+
+def plan_batch(videos: list, watchlist: Watchlist, rules: Rules):
+    """Decides what happens to each clip that isn't ignored, see rules.py"""
+    plan = []
+    for _, filepath in videos:
+        f = match_video(watchlist, filepath)
+        if f.ignored:
+            continue
 
-    vdf.write_videofile(folder + f.filename)
-    vdf.close()
+        clip = ClipFacts(f)
+        rule = rules.match(clip)
+        action = rule.action if rule else "skip"
+        # Work that was already done isn't repeated
+        if action == "upload" and f.uploaded or action == "archive" and f.archived:
+            action = "skip"
+        plan.append(PlannedClip(clip, rule, action))
+    return plan
+
+
+def print_plan(plan: list):
+    header = ["Filename", "Game", "Rule", "Action"]
+    data = [[p.clip.f.filename, p.clip.game, p.rule.name, p.action]
+            for p in plan if p.action != "skip"]
+    if data:
+        tt.print(data, header=header)
+
+    def planned(action):
+        return [p for p in plan if p.action == action]
+
+    uploads = planned("upload")
+    upload_seconds = [p.rule.clip_seconds(p.clip) for p in uploads]
+    # Clips are assumed to keep the source's bitrate
+    upload_bytes = sum(p.clip.size * seconds / p.clip.duration
+                       for p, seconds in zip(uploads, upload_seconds) if p.clip.duration)
+    archives = planned("archive")
+    deletes = planned("delete")
+
+    print_info(f"Upload: {len(uploads)} clips, {sum(upload_seconds):.0f}s of video to encode, about {format_bytes(upload_bytes)} to upload.")
+    print_info(f"Archive: {len(archives)} videos, {sum(p.clip.duration for p in archives):.0f}s of video to compress, {format_bytes(sum(p.clip.size for p in archives))} to read.")
+    print_info(f"Delete: {len(deletes)} videos, {format_bytes(sum(p.clip.size for p in deletes))} freed.")
+    print_info(f"Ignore: {len(planned('ignore'))} videos. Skip: {len(planned('skip'))} videos.")
+
+
+def run_batch(plan: list, watchlist: Watchlist, store: WatchlistStore, pipeline: ClipPipeline, folder=None, jobs=1):
+    """Carries out the plan, uploads go through the pipeline while the archive jobs run"""
+    if folder is None:
+        folder = initconfig.ARCHIVE_FOLDER
+
+    for p in plan:
+        if p.action == "upload":
+            pipeline.submit(p.rule.make_clip(p.clip), p.clip.f)
+        elif p.action == "delete":
+            delete_video(p.clip.f, watchlist)
+        elif p.action == "ignore":
+            p.clip.f.ignored = True
+
+    archives = [p.clip.f for p in plan if p.action == "archive"]
+    if archives:
+        archive_parallel(archives, watchlist, store, folder, jobs)
+
+
+def watch(watchlist: Watchlist, store: WatchlistStore, pipeline: ClipPipeline, rules=None, folder=None, jobs=1):
+    """Adds clips to the watchlist as they land and applies the rules to them, until Ctrl+C"""
+    watcher = ClipWatcher()
+    print_info(
+        f"Watching {watcher.root} for new clips ({watcher.mode}), press Ctrl+C to stop.")
+    try:
+        while True:
+            ready, removed = watcher.poll()
+            for path in removed:
+                f = watchlist.find(path)
+                if f:
+                    f.missing = True
+
+            if ready:
+                ingest(ready, watchlist, store, pipeline, rules, folder, jobs)
+
+            # Collected on every poll, finished uploads are reported and
+            # marked while clips keep landing
+            collected = pipeline.collect()
+            if ready or removed or collected:
+                store.save(watchlist, verbose=False)
+            time.sleep(watcher.poll_seconds)
+    except KeyboardInterrupt:
+        print_info("Stopped watching.")
+    finally:
+        watcher.stop()
+
+
+def ingest(paths: list, watchlist: Watchlist, store: WatchlistStore, pipeline: ClipPipeline, rules=None, folder=None, jobs=1):
+    """Adds the clips that are new to the watchlist, probes them and runs the rules on them"""
+    videos = []
+    for path in paths:
+        if watchlist.find(path):
+            continue
+        known = len(watchlist)
+        match_video(watchlist, path)
+        # Moved clips keep their entry and what was decided for them
+        if len(watchlist) == known:
+            continue
 
-    f.archived = True
+        try:
+            get_media_info(path)
+        except Exception as e:
+            print_warning(f"Couldn't read the new clip {path}: {e}")
+            continue
+        videos.append((os.path.basename(path), path))
 
+    if not videos:
+        return
+    print_info(f"{len(videos)} new clips: {', '.join(name for name, _ in videos)}")
+    if rules is not None:
+        plan = plan_batch(videos, watchlist, rules)
+        print_plan(plan)
+        run_batch(plan, watchlist, store, pipeline, folder=folder, jobs=jobs)
 
-def checkup(f: WatchlistFile, watchlist: Watchlist, auth_service, ignore_uploaded=False):
+
+def checkup(f: WatchlistFile, watchlist: Watchlist, pipeline: ClipPipeline, ignore_uploaded=False, previews=None):
     print_info(f"Running checkup for: {f.filename}")
 
     if not f.uploaded:
@@ -118,7 +603,7 @@ Nothing has been done to this video."""
                 options, message, default="s", description=description)
 
             if confirm == 'p':
-                preview_video(f)
+                preview_video(f, previews)
             elif confirm == 'd':
                 delete_video(f, watchlist)
                 return
@@ -130,11 +615,22 @@ Nothing has been done to this video."""
 
         # Clip preferences
         clip = get_clip_preferences(f.filepath)
-        clip.write_clip_file()
+        clips = [clip]
+        if clip.clip_mode == "i":
+            clips += get_more_intervals(clip)
 
-        # Upload video
-        clip.upload(auth_service)
-        f.uploaded = True
+        options = {"y": "yes", "n": "no"}
+        archive = input_selection(
+            options, "Archive the video in the same pass? ", default="n") == "y"
+
+        # Encode and upload in the background, marked as uploaded once it finishes
+        if archive or len(clips) > 1:
+            # Decoded once for every output instead of once per clip and archive
+            pipeline.submit_many(clips, f, lambda: render_clips(f, clips, archive=archive),
+                                 archive=archive)
+        else:
+            pipeline.submit(clip, f)
+        return
 
     if f.uploaded and not ignore_uploaded:
         if f.archived:
@@ -156,7 +652,7 @@ This video has been uploaded and archived."""
                     options, message, default="s", description=description)
 
                 if confirm == 'p':
-                    preview_video(f)
+                    preview_video(f, previews)
                 elif confirm == 'i':
                     f.ignored = True
                     return
@@ -186,7 +682,7 @@ This video has been uploaded."""
                     options, message, default="s", description=description)
 
                 if confirm == 'p':
-                    preview_video(f)
+                    preview_video(f, previews)
                 elif confirm == 'i':
                     f.ignored = True
                     return
@@ -210,17 +706,42 @@ if __name__ == "__main__":
     parser.add_argument('--archive-all', action="store_true",
                         help="archive every video")
     parser.add_argument('--archive-dir', help="overwrite archive directory")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of videos archived in parallel")
+    parser.add_argument('--upload-jobs', type=int,
+                        help="number of clips uploaded in parallel")
+    parser.add_argument('--encode-jobs', type=int,
+                        help="number of clips encoded in parallel")
     parser.add_argument('-s', '--status', action="store_true",
                         help="prints watchlist status")
     parser.add_argument('--reset', action="store_true",
                         help="reset watchlist file, see --clean")
     parser.add_argument('--clean', action="store_true",
                         help="clean missing files from watchlist file")
+    parser.add_argument('--dedupe', action="store_true",
+                        help="report duplicate videos that can be reclaimed")
+    parser.add_argument('--batch', action="store_true",
+                        help="handle every clip following the rules file instead of asking")
+    parser.add_argument('--rules', help="overwrite rules file used by --batch")
+    parser.add_argument('--dry-run', action="store_true",
+                        help="print what --batch would do and the estimated work, without doing it")
+    parser.add_argument('--watch', action="store_true",
+                        help="keep running and handle new clips as they're saved, following the rules file if there is one")
+    parser.add_argument('--profile', nargs='?', const=True, metavar="EVENTS_FILE",
+                        help="print where the time went on exit, events are written as JSON lines to EVENTS_FILE (profile.jsonl in the cache folder by default)")
 
     args = parser.parse_args()
 
+    if args.profile:
+        events_file = os.path.join(
+            initconfig.CACHE_FOLDER, PROFILE_FILE) if args.profile is True else args.profile
+        atexit.register(print_profile, instrument.enable(events_file))
+
+    store = open_watchlist_store()
+
     if args.status:
-        print(read_watchlist_file())
+        print(store.status())
+        print(QuotaLedger().status())
         exit()
 
     if args.archive_dir:
@@ -232,7 +753,7 @@ if __name__ == "__main__":
             args.archive_dir = args.archive_dir + os.path.sep
         print_info(f"Overwriting archive directory with: {args.archive_dir}")
 
-        archive_uploaded(directory=args.archive_dir)
+        archive_uploaded(folder=args.archive_dir, jobs=args.jobs, store=store)
 
     if args.archive_uploaded:
         description = "This will only archive the ones that haven't been archived.\nIf you wish to force the archival of every uploaded video use --force-archive."
@@ -245,7 +766,7 @@ if __name__ == "__main__":
             print_info("Cancelling...")
             exit()
 
-        archive_uploaded()
+        archive_uploaded(jobs=args.jobs, store=store)
         exit()
 
     if args.archive_all:
@@ -259,54 +780,96 @@ if __name__ == "__main__":
             print_info("Cancelling...")
             exit()
 
-        archive_uploaded(force=True)
+        archive_uploaded(force=True, jobs=args.jobs, store=store)
         exit()
 
     if args.reset:
         print_info("Resetting watchlist file...")
-        write_watchlist_file(Watchlist())
+        store.save(Watchlist())
         exit()
 
     if args.clean:
         print_info("Cleaning watchlist file...")
-        watchlist = read_watchlist_file()
-        for f in watchlist.files:
-            if f.missing:
-                watchlist.remove_file(f)
-        write_watchlist_file(watchlist)
+        watchlist = store.load()
+        removed = watchlist.retain(lambda f: not f.missing)
+        print_info(f"Removed {len(removed)} missing files.")
+        store.save(watchlist)
+        exit()
+
+    if args.dedupe:
+        watchlist = store.load()
+        dedupe_report(watchlist)
+        store.save(watchlist)
         exit()
 
     if args.ignore:
         print_info("Ignoring uploaded files...")
         # NO BREAK
 
-    # Youtube API
-    auth_service = get_authenticated_service()
+    rules = None
+    if args.batch or args.watch and (args.rules or os.path.exists(initconfig.RULES_FILE)):
+        # Read first so a broken rules file fails before anything is done
+        rules = Rules(args.rules)
+        print_info(f"Read {len(rules.rules)} rules from {rules.fname}.")
+
+        if args.batch and args.dry_run:
+            # Planned on a detached copy, matching clips adds entries and
+            # fingerprints that mustn't reach the store
+            watchlist = store.load()
+            watchlist.store = None
+            print_plan(plan_batch(get_videos_in_directory(save=False), watchlist, rules))
+            exit()
+
+    backend = get_upload_backend()
+    backend.start()
 
     # Check files in directory VIDEOS_FOLDER:
-    videos = get_videos_in_directory()
+    # --watch picks up what changed since the last scan itself
+    videos = [] if args.watch else get_videos_in_directory()
 
     # Read files already in watchlist
-    watchlist = read_watchlist_file()
-
-    for video in videos:
-        video_to_check = None
+    watchlist = store.load()
+
+    # Uploads interrupted on a previous run
+    for source in backend.resume(UploadJournal()):
+        resumed = watchlist.find(source)
+        if resumed:
+            resumed.uploaded = True
+
+    # Unset worker counts fall back to the config file
+    pipeline = ClipPipeline(encode_workers=None if args.encode_jobs is None else max(1, args.encode_jobs),
+                            upload_workers=None if args.upload_jobs is None else max(1, args.upload_jobs),
+                            backend=backend)
+    # Uploads held back by the quota on a previous run
+    pipeline.uploads.restore(watchlist)
+
+    if args.watch:
+        watch(watchlist, store, pipeline, rules,
+              folder=args.archive_dir, jobs=args.jobs)
+    elif args.batch:
+        plan = plan_batch(videos, watchlist, rules)
+        print_plan(plan)
+        run_batch(plan, watchlist, store, pipeline,
+                  folder=args.archive_dir, jobs=args.jobs)
+    else:
+        # Adds the videos to the watchlist if they're not there yet
+        to_check = [f for f in (match_video(watchlist, video[1]) for video in videos)
+                    if not f.ignored and not (args.ignore and f.uploaded)]
 
-        for wl_file in watchlist.nonmissing_files():
-            if wl_file.filename == video[0]:
-                video_to_check = wl_file
-                break
+        # Rendered in checkup order, so the next previews are ready by the time they're needed
+        previews = PreviewWorker()
+        for f in to_check:
+            previews.submit(f)
 
-        # Not in watchlist
-        if not video_to_check:
-            # Add to watchlist
-            video_to_check = WatchlistFile(video[1])
-            watchlist.add_file(video_to_check)
+        try:
+            for video_to_check in to_check:
+                # Run checkup
+                checkup(video_to_check, watchlist, pipeline,
+                        args.ignore, previews.cache)
+        finally:
+            previews.stop()
 
-        if video_to_check.ignored:
-            continue
-        # Run checkup
-        checkup(video_to_check, watchlist, auth_service, args.ignore)
+    pipeline.finish()
 
     # Update watchlist
-    write_watchlist_file(watchlist)
+    store.save(watchlist)
@@ -0,0 +1,203 @@
+"""Low resolution proxies and contact sheets rendered ahead of triage."""
+import math
+import os
+import queue
+import subprocess
+import threading
+import initconfig
+from fingerprint import file_fingerprint
+from helpers import WatchlistFile, print_warning
+from highlights import get_highlights
+from media import ffmpeg_command, get_media_info
+
+PREVIEW_FOLDER = "previews"
+PROXY_SUFFIX = ".proxy.mp4"
+SHEET_SUFFIX = ".sheet.jpg"
+PARTIAL_SUFFIX = ".part"
+
+PROXY_FPS = 30
+# Width of each thumbnail in the contact sheet
+THUMBNAIL_WIDTH = 320
+
+
+class PreviewCache():
+    """Previews in the cache folder, named after the clip's fingerprint
+
+    Previews survive clips being moved or renamed. The least recently used
+    ones are deleted once the folder grows past max_size (bytes).
+    """
+
+    def __init__(self, folder=None, max_size=None):
+        if folder is None:
+            folder = os.path.join(initconfig.CACHE_FOLDER, PREVIEW_FOLDER)
+        self.folder = folder
+        self.max_size = initconfig.PREVIEW_CACHE_SIZE if max_size is None else max_size
+        self.lock = threading.Lock()
+        self.opened = set()
+        os.makedirs(folder, exist_ok=True)
+
+        # Left by renders that were cut short
+        for name in os.listdir(folder):
+            if name.endswith(PARTIAL_SUFFIX):
+                os.remove(os.path.join(folder, name))
+
+    def key(self, f: WatchlistFile):
+        # Not stored on f, watchlist changes are only made from the main thread
+        return f.fingerprint or file_fingerprint(f.filepath)
+
+    def proxy_path(self, f: WatchlistFile):
+        return os.path.join(self.folder, self.key(f) + PROXY_SUFFIX)
+
+    def sheet_path(self, f: WatchlistFile):
+        return os.path.join(self.folder, self.key(f) + SHEET_SUFFIX)
+
+    def get(self, f: WatchlistFile):
+        """Path of the proxy, or the contact sheet if there's no proxy yet, None otherwise
+
+        A clip's preview is only given once, previewing it again opens the original.
+        """
+        if f.filepath in self.opened:
+            return None
+        for path in (self.proxy_path(f), self.sheet_path(f)):
+            if os.path.exists(path):
+                # Marks it as recently used
+                os.utime(path)
+                self.opened.add(f.filepath)
+                return path
+        return None
+
+    def ready(self, f: WatchlistFile):
+        return os.path.exists(self.proxy_path(f)) and os.path.exists(self.sheet_path(f))
+
+    def render(self, f: WatchlistFile, run=subprocess.run):
+        """Renders the missing contact sheet and proxy of f, the sheet first since it's quicker"""
+        sheet, proxy = self.sheet_path(f), self.proxy_path(f)
+        if not os.path.exists(sheet):
+            self.write(sheet, contact_sheet_args(f.filepath), run)
+        if not os.path.exists(proxy):
+            self.write(proxy, proxy_args(f.filepath), run)
+        self.evict()
+
+    def write(self, output: str, args, run):
+        partial = output + PARTIAL_SUFFIX
+        try:
+            # The muxer can't be guessed from the .part extension
+            run(ffmpeg_command(args + ["-f", "image2" if output.endswith(".jpg") else "mp4", partial]),
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, output)
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.folder):
+                if name.endswith(PARTIAL_SUFFIX):
+                    continue
+                st = os.stat(os.path.join(self.folder, name))
+                entries.append((st.st_mtime, st.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                os.remove(os.path.join(self.folder, name))
+                total -= size
+
+
+def proxy_args(source: str, height=None):
+    if height is None:
+        height = initconfig.PREVIEW_HEIGHT
+    return ["-i", source, "-vf", f"scale=-2:{height},fps={PROXY_FPS}",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
+            "-c:a", "aac", "-b:a", "64k", "-threads", "2"]
+
+
+def contact_sheet_args(source: str, count=None):
+    """One frame every duration / count seconds, tiled in a grid"""
+    if count is None:
+        count = initconfig.PREVIEW_THUMBNAILS
+    duration = get_media_info(source).duration or 1
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    return ["-i", source, "-vf", f"fps={count / duration},scale={THUMBNAIL_WIDTH}:-2,tile={columns}x{rows}",
+            "-frames:v", "1", "-q:v", "4"]
+
+
+def highlights_ready(filepath: str):
+    try:
+        return get_highlights(filepath, analyze=False) is not None
+    except OSError:
+        return False
+
+
+class PreviewWorker():
+    """Renders previews of the queued clips in background threads, in queue order"""
+
+    def __init__(self, cache=None, workers=None):
+        self.cache = PreviewCache() if cache is None else cache
+        self.workers = initconfig.PREVIEW_WORKERS if workers is None else workers
+        self.queue = queue.Queue()
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.run, daemon=True, name=f"preview-{i}")
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, f: WatchlistFile):
+        if self.workers and not (self.cache.ready(f) and highlights_ready(f.filepath)):
+            self.queue.put(f)
+
+    def run(self):
+        while True:
+            f = self.queue.get()
+            if f is None or self.stopped.is_set():
+                return
+            try:
+                self.cache.render(f, run=self.run_process)
+            except (OSError, subprocess.CalledProcessError) as e:
+                if not self.stopped.is_set():
+                    print_warning(f"Couldn't render the preview of {f.filename}: {e}")
+
+            # Ready by the time the clip's preferences are asked for, which
+            # don't wait for them
+            if self.stopped.is_set():
+                return
+            try:
+                get_highlights(f.filepath, popen=self.popen)
+            except Exception as e:
+                if not self.stopped.is_set():
+                    print_warning(f"Couldn't look for highlights in {f.filename}: {e}")
+
+    def popen(self, cmd: list, **kwargs):
+        """subprocess.Popen that stop() can terminate"""
+        process = subprocess.Popen(cmd, **kwargs)
+        with self.lock:
+            if self.stopped.is_set():
+                process.terminate()
+            # Finished processes are dropped as new ones start
+            self.processes = {p for p in self.processes if p.poll() is None}
+            self.processes.add(process)
+        return process
+
+    def run_process(self, cmd: list, check=True, **kwargs):
+        """subprocess.run that stop() can terminate"""
+        process = self.popen(cmd, **kwargs)
+        process.communicate()
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    def stop(self):
+        """Drops the queued clips and terminates the renders and analyses in progress"""
+        for _ in self.threads:
+            self.queue.put(None)
+        with self.lock:
+            self.stopped.set()
+            for process in self.processes:
+                process.terminate()
+        for thread in self.threads:
+            thread.join()
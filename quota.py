@@ -0,0 +1,137 @@
+"""Keeps track of the YouTube Data API quota spent on uploads.
+
+The API gives each project a daily budget of units, every videos.insert
+costs a fixed amount of them whether the upload succeeds or not, and the
+budget resets at midnight Pacific time. Uploads that would go over budget
+are held until the next window instead of failing on the server.
+"""
+import json
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import initconfig
+from upload import UploadError
+
+QUOTA_FILE = "upload_quota.json"
+# Fallback when there's no time zone database (e.g Windows without tzdata)
+PACIFIC_STANDARD_TIME = timezone(timedelta(hours=-8), "PST")
+
+# What initialize_upload needs of a held clip, it's already encoded
+HeldClip = namedtuple("HeldClip", ["clip_file_name", "source", "title", "description", "privacy_status"])
+
+
+class QuotaExceeded(UploadError):
+    pass
+
+
+def pacific_timezone():
+    try:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    except ImportError:
+        return PACIFIC_STANDARD_TIME
+    try:
+        return ZoneInfo("America/Los_Angeles")
+    except ZoneInfoNotFoundError:
+        return PACIFIC_STANDARD_TIME
+
+
+def quota_window(now=None):
+    """(day the quota is charged to, time it resets) for now, an aware datetime"""
+    tz = pacific_timezone()
+    now = datetime.now(tz) if now is None else now.astimezone(tz)
+    midnight = datetime(now.year, now.month, now.day, tzinfo=tz) + timedelta(days=1)
+    return now.date().isoformat(), midnight
+
+
+def is_quota_error(error):
+    """Whether an apiclient.errors.HttpError is the API refusing a request because the quota ran out"""
+    return error.resp.status == 403 and any(
+        reason in error.content for reason in (b"quotaExceeded", b"dailyLimitExceeded"))
+
+
+class QuotaLedger():
+    """Units spent in the current window and the uploads held for the next one
+
+    Persisted in CACHE_FOLDER so runs on the same day share the budget. Held
+    uploads are keyed by their clip file, which is already encoded.
+    """
+
+    def __init__(self, fname=None, budget=None, cost=None):
+        if fname is None:
+            fname = os.path.join(initconfig.CACHE_FOLDER, QUOTA_FILE)
+        self.fname = fname
+        self.budget = initconfig.UPLOAD_DAILY_QUOTA if budget is None else budget
+        self.cost = initconfig.UPLOAD_QUOTA_COST if cost is None else cost
+        self.lock = threading.Lock()
+        try:
+            with open(fname, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+
+        self.day = data.get("day")
+        self.spent = data.get("used", 0)
+        self.held = data.get("held", {})
+
+    def save(self):
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"day": self.day, "used": self.spent, "held": self.held}, f, indent=1)
+        os.replace(tmp, self.fname)
+
+    def roll(self):
+        """Starts a new window if the day changed, called with the lock held"""
+        day, _ = quota_window()
+        if day != self.day:
+            self.day = day
+            self.spent = 0
+
+    @property
+    def used(self):
+        with self.lock:
+            self.roll()
+            return self.spent
+
+    def remaining(self):
+        return max(self.budget - self.used, 0)
+
+    def reserve(self):
+        """Charges an upload to the current window, False if it would go over budget"""
+        with self.lock:
+            self.roll()
+            if self.spent + self.cost > self.budget:
+                return False
+            self.spent += self.cost
+            self.save()
+            return True
+
+    def exhaust(self):
+        """The server says the quota ran out, whatever was counted locally"""
+        with self.lock:
+            self.roll()
+            self.spent = max(self.spent, self.budget)
+            self.save()
+
+    def hold(self, clip):
+        with self.lock:
+            self.held[clip.clip_file_name] = {
+                "source": clip.source, "title": clip.title, "description": clip.description,
+                "privacy_status": clip.privacy_status}
+            self.save()
+
+    def held_clips(self):
+        with self.lock:
+            return [HeldClip(clip_file, **entry) for clip_file, entry in self.held.items()]
+
+    def release(self, clip_file: str):
+        with self.lock:
+            if self.held.pop(clip_file, None) is not None:
+                self.save()
+
+    def status(self):
+        _, resets = quota_window()
+        used = self.used
+        uploads = max(self.budget - used, 0) // self.cost if self.cost else 0
+        return (f"Upload quota: {used}/{self.budget} units used today, {uploads} uploads left, "
+                f"{len(self.held)} held, resets at {resets.astimezone():%Y-%m-%d %H:%M}.")
@@ -0,0 +1,206 @@
+"""Rules that decide what happens to each clip in batch mode, read from an INI file.
+
+Each section is a rule, the first rule whose conditions all match a clip
+decides its action, clips that match no rule are skipped. For example:
+
+    [Old desktop recordings]
+    GAME = Desktop
+    OLDER_THAN_DAYS = 30
+    ACTION = delete
+
+    [Valorant highlights]
+    GAME = Valorant
+    UPLOADED = no
+    ACTION = upload
+    CLIP_MODE = e
+    TIME_FROM = 30
+    TITLE = {game} {date}
+"""
+import configparser
+import os
+import time
+from datetime import datetime
+from fnmatch import fnmatch
+import initconfig
+from helpers import WatchlistFile, YoutubeClip
+from media import get_media_info
+
+ACTIONS = ("upload", "archive", "delete", "ignore", "skip")
+
+# condition -> (type, test of the clip's value against the rule's value)
+CONDITIONS = {
+    "game": (str, lambda clip, games: any(fnmatch(clip.game.lower(), g.strip().lower())
+                                          for g in games.split(","))),
+    "older_than_days": (float, lambda clip, days: clip.age_days > days),
+    "newer_than_days": (float, lambda clip, days: clip.age_days < days),
+    "longer_than": (float, lambda clip, seconds: clip.duration > seconds),
+    "shorter_than": (float, lambda clip, seconds: clip.duration < seconds),
+    "larger_than_mb": (float, lambda clip, mb: clip.size > mb * 1024 * 1024),
+    "smaller_than_mb": (float, lambda clip, mb: clip.size < mb * 1024 * 1024),
+    "uploaded": (bool, lambda clip, value: clip.f.uploaded == value),
+    "archived": (bool, lambda clip, value: clip.f.archived == value),
+}
+
+# Options of upload rules, missing ones use the defaults in the config file
+CLIP_OPTIONS = ("clip_mode", "time_from", "interval", "title", "description",
+                "privacy_status", "smart_cut")
+# Fields that can be used in titles and descriptions, e.g "{game} {date}"
+TEMPLATE_FIELDS = dict.fromkeys(("game", "filename", "date", "time"), "")
+
+
+class ClipFacts():
+    """What rules test about a clip, each fact is only read when a rule needs it"""
+
+    def __init__(self, f: WatchlistFile, root=None):
+        self.f = f
+        self.root = os.path.abspath(initconfig.VIDEO_FOLDER if root is None else root)
+        self._stat = None
+
+    @property
+    def game(self):
+        """NVIDIA keeps clips in a folder per game, clips in the root have no game"""
+        folder = os.path.dirname(os.path.abspath(self.f.filepath))
+        return "" if folder == self.root else os.path.basename(folder)
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.f.filepath)
+        return self._stat
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    @property
+    def age_days(self):
+        return (time.time() - self.stat.st_mtime) / 86400
+
+    @property
+    def duration(self):
+        return get_media_info(self.f.filepath).duration
+
+    def template_fields(self):
+        date = datetime.fromtimestamp(self.stat.st_mtime)
+        return {"game": self.game or "Clip", "filename": os.path.splitext(self.f.filename)[0],
+                "date": date.strftime("%Y-%m-%d"), "time": date.strftime("%H.%M.%S")}
+
+
+class Rule():
+    def __init__(self, name: str, section: configparser.SectionProxy, fname: str):
+        self.name = name
+        self.action = section.get("action", "").strip().lower()
+        if self.action not in ACTIONS:
+            raise Exception(
+                f"Invalid action ({self.action}) for rule [{name}] in {fname}, expected one of {', '.join(ACTIONS)}.")
+
+        self.conditions = []
+        self.options = {}
+        for option in section:
+            if option == "action":
+                continue
+            if option in CONDITIONS:
+                kind, test = CONDITIONS[option]
+                self.conditions.append((test, self.parse(section, option, kind, fname)))
+            elif option in CLIP_OPTIONS and self.action == "upload":
+                self.options[option] = section.get(option)
+            else:
+                raise Exception(f"Unknown option {option} for rule [{name}] in {fname}.")
+
+        # Fails on load rather than halfway through a batch
+        if self.action == "upload":
+            settings = self.clip_settings()
+            mode = settings.get("clip_mode", initconfig.DEFAULT_CLIP_MODE)
+            if mode in "es" and "time_from" not in settings:
+                raise Exception(f"Rule [{name}] in {fname} needs time_from to upload.")
+            if mode == "i" and len(settings.get("interval", ())) != 2:
+                raise Exception(f"Rule [{name}] in {fname} needs an interval (e.g 55 135) to upload.")
+            for option in ("title", "description"):
+                try:
+                    self.options.get(option, "").format(**TEMPLATE_FIELDS)
+                except (KeyError, IndexError, ValueError):
+                    raise Exception(
+                        f"Invalid {option} for rule [{name}] in {fname}, the fields are {', '.join('{' + f + '}' for f in TEMPLATE_FIELDS)}.")
+
+    @staticmethod
+    def parse(section: configparser.SectionProxy, option: str, kind, fname: str):
+        try:
+            if kind is bool:
+                return section.getboolean(option)
+            return kind(section.get(option))
+        except ValueError:
+            raise Exception(
+                f"Invalid value ({section.get(option)}) for {option} in rule [{section.name}] in {fname}.")
+
+    def matches(self, clip: ClipFacts):
+        return all(test(clip, value) for test, value in self.conditions)
+
+    def clip_settings(self):
+        """Keyword arguments for YoutubeClip, templates are filled in by make_clip"""
+        settings = {}
+        options = self.options
+        if "clip_mode" in options:
+            settings["clip_mode"] = options["clip_mode"].strip().lower()
+            if settings["clip_mode"] not in ("e", "s", "i"):
+                raise Exception(f"Invalid clip_mode ({options['clip_mode']}) for rule [{self.name}].")
+        try:
+            if "time_from" in options:
+                settings["time_from"] = float(options["time_from"])
+            if "interval" in options:
+                settings["interval"] = [float(t) for t in options["interval"].split()]
+        except ValueError:
+            raise Exception(f"Invalid time_from or interval for rule [{self.name}].")
+        if "privacy_status" in options:
+            settings["privacy_status"] = options["privacy_status"].strip().lower()
+            if settings["privacy_status"] not in initconfig.VALID_PRIVACY_STATUSES:
+                raise Exception(
+                    f"Invalid privacy_status ({options['privacy_status']}) for rule [{self.name}].")
+        if "smart_cut" in options:
+            settings["smart_cut"] = options["smart_cut"].strip().lower() in ("1", "yes", "true", "on")
+        return settings
+
+    def make_clip(self, clip: ClipFacts):
+        settings = self.clip_settings()
+        # Like get_clip_preferences, (e)nd mode counts back from the end
+        if settings.get("clip_mode", initconfig.DEFAULT_CLIP_MODE) == "e" and "time_from" in settings:
+            settings["time_from"] = -abs(settings["time_from"])
+
+        fields = clip.template_fields()
+        title = self.options.get("title", initconfig.DEFAULT_TITLE).format(**fields)
+        description = self.options.get(
+            "description", initconfig.DEFAULT_DESCRIPTION).format(**fields)
+        return YoutubeClip(clip.f.filepath, title=title, description=description,
+                           clip_file_name=f"{fields['filename']}.mp4", **settings)
+
+    def clip_seconds(self, clip: ClipFacts):
+        """Seconds of the source that an upload rule cuts, for the estimates"""
+        settings = self.clip_settings()
+        mode = settings.get("clip_mode", initconfig.DEFAULT_CLIP_MODE)
+        if mode == "i" and "interval" in settings:
+            return max(0, settings["interval"][1] - settings["interval"][0])
+        if "time_from" in settings:
+            if mode == "e":
+                return min(abs(settings["time_from"]), clip.duration)
+            return max(0, clip.duration - settings["time_from"])
+        return clip.duration
+
+
+class Rules():
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = initconfig.RULES_FILE
+        if not os.path.exists(fname):
+            raise Exception(f"Couldn't find the rules file: {fname}")
+
+        # Titles and descriptions may contain %
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(fname)
+        self.fname = fname
+        self.rules = [Rule(name, config[name], fname) for name in config.sections()]
+
+    def match(self, clip: ClipFacts):
+        """The first rule that matches clip, None if there isn't one"""
+        for rule in self.rules:
+            if rule.matches(clip):
+                return rule
+        return None
@@ -0,0 +1,119 @@
+"""Incremental clip scanner backed by a persisted directory cache."""
+import json
+import os
+import initconfig
+
+SCAN_CACHE_FILE = "scan_cache.json"
+VIDEO_EXTENSION = ".mp4"
+
+
+class ClipScanner():
+    """Scans the video folder and its game folders (NVIDIA groups clips by game)
+
+    The cache records each directory's mtime with its subfolders and the
+    (size, mtime) of each clip. A directory whose mtime didn't change isn't
+    listed again, so an unchanged library costs one stat per folder.
+
+    Note that a directory's mtime only changes when entries are added, removed
+    or renamed, a clip that is rewritten in place is picked up the next time
+    its folder changes.
+    """
+
+    def __init__(self, root=None, cache_file=None):
+        if root is None:
+            root = initconfig.VIDEO_FOLDER
+        self.root = os.path.abspath(root)
+        if cache_file is None:
+            cache_file = os.path.join(initconfig.CACHE_FOLDER, SCAN_CACHE_FILE)
+        self.cache_file = cache_file
+        self.cache = self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if cache.get("root") != self.root:
+            return {}
+        return cache.get("dirs", {})
+
+    def save_cache(self, dirs: dict):
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"root": self.root, "dirs": dirs}, f)
+        os.replace(tmp, self.cache_file)
+        self.cache = dirs
+
+    def scan(self, changed_only=False, save=True):
+        """Yields (filename, filepath) for the clips in the root and game folders
+
+        Parameters
+        ----------
+        changed_only : bool, optional
+            only yield clips that are new or whose size/mtime changed since the
+            last scan, by default False
+        save : bool, optional
+            whether the cache is saved, a scan that isn't counts for nothing,
+            by default True
+
+        The cache is only saved once the generator is exhausted.
+        """
+        dirs = {}
+
+        root = self.scan_directory(self.root, dirs)
+        if root is None:
+            if save:
+                self.save_cache(dirs)
+            return
+
+        for sub_folder in [self.root] + [os.path.join(self.root, d) for d in root["dirs"]]:
+            entry = dirs.get(sub_folder) or self.scan_directory(sub_folder, dirs)
+            if entry is None:
+                continue
+
+            previous = self.cache.get(sub_folder, {}).get("files", {})
+            for name, stats in entry["files"].items():
+                if changed_only and previous.get(name) == stats:
+                    continue
+                yield name, os.path.join(sub_folder, name)
+
+        if save:
+            self.save_cache(dirs)
+
+    def clip_paths(self):
+        """Paths of the clips found by the last scan"""
+        return {os.path.join(folder, name) for folder, entry in self.cache.items()
+                for name in entry["files"]}
+
+    def scan_directory(self, path: str, dirs: dict):
+        """Stats path and only lists it again if its mtime changed"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        cached = self.cache.get(path)
+        if cached and cached["mtime"] == mtime:
+            dirs[path] = cached
+            return cached
+
+        entry = {"mtime": mtime, "dirs": [], "files": {}}
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        entry["dirs"].append(dir_entry.name)
+                    elif dir_entry.name.lower().endswith(VIDEO_EXTENSION) and dir_entry.is_file():
+                        st = dir_entry.stat()
+                        entry["files"][dir_entry.name] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            # Unreadable or removed while listing, the folder is skipped and
+            # what was known of it kept, it's listed again next time
+            if cached:
+                dirs[path] = cached
+            return cached
+
+        dirs[path] = entry
+        return entry
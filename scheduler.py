@@ -0,0 +1,364 @@
+"""Schedulers that run uploads in the background while the checkup loop goes on."""
+import os
+import queue
+import threading
+import time
+import termtables as tt
+from concurrent.futures import ThreadPoolExecutor
+import initconfig
+from helpers import Watchlist, WatchlistFile, YoutubeClip, print_error, print_info, print_warning
+from backends import get_upload_backend
+from quota import QuotaExceeded, QuotaLedger, quota_window
+from upload import UploadJournal, format_bytes
+
+
+class UploadJob():
+    def __init__(self, clip: YoutubeClip, f: WatchlistFile):
+        self.clip = clip
+        self.file = f
+        self.future = None
+        self.error = None
+        self.elapsed = 0
+        self.size = 0
+        # Whether the encode also archived the file, see ClipPipeline.submit_many
+        self.archive = False
+
+
+class UploadQueue():
+    """Runs up to workers uploads at once
+
+    Clients aren't shared between threads (httplib2.Http isn't thread-safe),
+    each worker thread builds its own with the upload backend. Watchlist files are only marked as uploaded by
+    finish(), from the calling thread, once their upload succeeded.
+
+    Uploads that don't fit in what's left of the daily quota are held, see
+    quota.py, and submitted by collect() once the quota resets. The ones
+    still held when the queue finishes are picked up by restore() on the
+    next run.
+    """
+
+    def __init__(self, workers=None, backend=None, ledger=None):
+        if workers is None:
+            workers = initconfig.UPLOAD_WORKERS
+        self.workers = workers
+        self.backend = get_upload_backend() if backend is None else backend
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload")
+        self.local = threading.local()
+        self.journal = UploadJournal()
+        self.ledger = QuotaLedger() if ledger is None else ledger
+        self.jobs = []
+        self.held = []
+        self.lock = threading.Lock()
+
+    def client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.backend.client()
+        return self.local.client
+
+    def submit(self, clip: YoutubeClip, f: WatchlistFile):
+        job = UploadJob(clip, f)
+        if self.backend.quota and not self.ledger.reserve():
+            self.hold(job)
+            return job
+        self.start(job)
+        print_info(
+            f"Queued upload of {clip.title} ({self.backlog()} in queue).")
+        return job
+
+    def start(self, job: UploadJob):
+        job.error = None
+        job.future = self.executor.submit(self.run, job)
+        self.jobs.append(job)
+
+    def hold(self, job: UploadJob):
+        """Keeps job until the quota resets, instead of failing on the server"""
+        with self.lock:
+            self.held.append(job)
+        self.ledger.hold(job.clip)
+        _, resets = quota_window()
+        print_warning(
+            f"The daily upload quota is used up, {job.clip.title} is held until {resets.astimezone():%Y-%m-%d %H:%M}.")
+
+    def release(self):
+        """Submits the held uploads that fit in the current quota window"""
+        with self.lock:
+            held, self.held = self.held, []
+        waiting = []
+        for job in held:
+            if waiting or self.backend.quota and not self.ledger.reserve():
+                waiting.append(job)
+                continue
+            self.start(job)
+            print_info(f"Released held upload of {job.clip.title}.")
+        with self.lock:
+            self.held = waiting + self.held
+
+    def restore(self, watchlist: Watchlist):
+        """Holds the uploads a previous run left held, then releases what the quota allows"""
+        restored = 0
+        for clip in self.ledger.held_clips():
+            f = watchlist.find(clip.source)
+            if f is None or f.uploaded or not os.path.exists(clip.clip_file_name):
+                self.ledger.release(clip.clip_file_name)
+                continue
+            with self.lock:
+                self.held.append(UploadJob(clip, f))
+            restored += 1
+        if restored:
+            print_info(f"{restored} uploads were held by a previous run.")
+            self.release()
+
+    def run(self, job: UploadJob):
+        def log(message):
+            print(f"[{job.clip.title}] {message}")
+
+        start = time.time()
+        job.size = os.path.getsize(job.clip.clip_file_name)
+        try:
+            self.backend.upload(self.client(), job.clip,
+                                journal=self.journal, log=log)
+        except QuotaExceeded:
+            # Every upload after this one would fail too
+            self.ledger.exhaust()
+            raise
+        finally:
+            job.elapsed = time.time() - start
+
+        self.ledger.release(job.clip.clip_file_name)
+
+    def backlog(self):
+        """Uploads that haven't finished yet"""
+        return sum(1 for job in self.jobs if not job.future.done())
+
+    def collect(self):
+        """Marks the uploads that finished so far without waiting for the rest
+
+        Uploads that ran into the quota are held again, held uploads are
+        released if the quota reset since the last call.
+
+        Returns
+        -------
+        list
+            jobs that finished, the ones that failed have their error set
+        """
+        if self.held:
+            self.release()
+
+        done = [job for job in self.jobs if job.future.done()]
+        finished = []
+        for job in done:
+            self.jobs.remove(job)
+            try:
+                job.future.result()
+            except QuotaExceeded:
+                self.hold(job)
+                continue
+            except Exception as e:
+                job.error = e
+                print_error(f"Upload of {job.clip.title} failed: {e}")
+            else:
+                job.file.uploaded = True
+                print_info(f"Uploaded {job.clip.title} in {job.elapsed:.0f}s.")
+            finished.append(job)
+        return finished
+
+    def finish(self):
+        """Waits for every upload, marks the successful ones and prints a summary
+
+        Returns
+        -------
+        list
+            jobs that failed
+        """
+        if not self.jobs:
+            self.executor.shutdown()
+            self.print_held()
+            return []
+
+        print_info(f"Waiting for {self.backlog()} uploads to finish...")
+        failed = []
+        data = []
+        for job in self.jobs:
+            try:
+                job.future.result()
+            except QuotaExceeded:
+                self.hold(job)
+                continue
+            except Exception as e:
+                job.error = e
+                failed.append(job)
+                print_error(f"Upload of {job.clip.title} failed: {e}")
+            else:
+                job.file.uploaded = True
+
+            speed = job.size / job.elapsed if job.elapsed else 0
+            data.append([job.clip.title, "failed" if job.error else "uploaded",
+                         format_bytes(job.size), f"{job.elapsed:.0f}s", f"{format_bytes(speed)}/s"])
+
+        self.executor.shutdown()
+        for job in self.held:
+            data.append([job.clip.title, "held", "-", "-", "-"])
+        if data:
+            tt.print(data, header=["Title", "Status",
+                     "Size", "Time", "Throughput"])
+        print_info(
+            f"{len(data) - len(self.held) - len(failed)} uploads finished, {len(failed)} failed.")
+        self.print_held()
+        self.jobs = []
+        return failed
+
+    def print_held(self):
+        if self.held:
+            _, resets = quota_window()
+            print_warning(
+                f"{len(self.held)} uploads are held until the quota resets at {resets.astimezone():%Y-%m-%d %H:%M}, they're uploaded by the next run after that.")
+
+
+class ClipPipeline():
+    """Two stage pipeline, encoding a clip overlaps uploading the previous ones
+
+    Encoded clips wait in a bounded queue for a free upload worker, when it's
+    full the encode workers block, so for a batch of clips the wall-clock time
+    approaches max(encode, upload) instead of their sum.
+    """
+
+    def __init__(self, encode_workers=None, upload_workers=None, queue_size=None,
+                 backend=None):
+        if encode_workers is None:
+            encode_workers = initconfig.ENCODE_WORKERS
+        if upload_workers is None:
+            upload_workers = initconfig.UPLOAD_WORKERS
+        if queue_size is None:
+            queue_size = initconfig.PIPELINE_QUEUE_SIZE
+        self.encode_executor = ThreadPoolExecutor(
+            max_workers=encode_workers, thread_name_prefix="encode")
+        self.encoded = queue.Queue(maxsize=queue_size)
+        self.uploads = UploadQueue(upload_workers, backend)
+        self.upload_slots = threading.Semaphore(upload_workers)
+        self.encode_jobs = []
+        # Clip files of the submitted clips, they may not be written yet
+        self.clip_files = set()
+        self.dispatcher = threading.Thread(
+            target=self.dispatch, name="dispatch", daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, clip: YoutubeClip, f: WatchlistFile):
+        return self.submit_many([clip], f, clip.write_clip_file)[0]
+
+    def submit_many(self, clips: list, f: WatchlistFile, encode, archive=False):
+        """Writes every clip of f with a single call of encode, then uploads each of them
+
+        encode is e.g a render of every clip (and the archive of f if archive
+        is True) from one decode of f, f is marked as archived once it returns.
+        """
+        for clip in clips:
+            self.claim_clip_file(clip)
+        jobs = [UploadJob(clip, f) for clip in clips]
+        future = self.encode_executor.submit(self.encode, jobs, encode)
+        for job in jobs:
+            job.future = future
+            job.archive = archive
+        self.encode_jobs += jobs
+        self.print_backlog()
+        return jobs
+
+    def claim_clip_file(self, clip: YoutubeClip):
+        """Numbers clip's file if another clip of this run or a file on disk has its name
+
+        Clips are named after their title, two clips with the same title would
+        overwrite each other while the first one waits for its upload, and
+        share its entries in the upload journal and the quota ledger.
+        """
+        base, ext = os.path.splitext(clip.clip_file_name)
+        path = clip.clip_file_name
+        count = 1
+        while os.path.normcase(os.path.abspath(path)) in self.clip_files or os.path.exists(path):
+            count += 1
+            path = f"{base} ({count}){ext}"
+        self.clip_files.add(os.path.normcase(os.path.abspath(path)))
+        clip.clip_file_name = path
+
+    def encode(self, jobs: list, encode):
+        start = time.time()
+        encode()
+        elapsed = time.time() - start
+        for job in jobs:
+            job.elapsed = elapsed
+            print_info(f"Encoded {job.clip.title} in {job.elapsed:.0f}s.")
+            # Blocks while the queue is full
+            self.encoded.put(job)
+
+    def dispatch(self):
+        while True:
+            job = self.encoded.get()
+            if job is None:
+                return
+            self.upload_slots.acquire()
+            upload = self.uploads.submit(job.clip, job.file)
+            if upload.future is None:
+                # Held, see UploadQueue.hold
+                self.upload_slots.release()
+            else:
+                upload.future.add_done_callback(
+                    lambda _: self.upload_slots.release())
+
+    def backlog(self):
+        return {"encode": len({job.future for job in self.encode_jobs if not job.future.done()}),
+                "queued": self.encoded.qsize(),
+                "upload": self.uploads.backlog()}
+
+    def print_backlog(self):
+        backlog = self.backlog()
+        print_info(
+            f"Pipeline backlog: {backlog['encode']} encoding, {backlog['queued']} waiting, {backlog['upload']} uploading.")
+
+    def collect(self):
+        """Reports the failed encodes and marks the finished uploads, see UploadQueue.collect
+
+        Returns
+        -------
+        list
+            jobs whose encode failed or archived their file, then the
+            finished uploads
+        """
+        collected = []
+        for job in [job for job in self.encode_jobs if job.future.done()]:
+            self.encode_jobs.remove(job)
+            try:
+                job.future.result()
+            except Exception as e:
+                job.error = e
+                collected.append(job)
+                print_error(f"Encoding of {job.clip.title} failed: {e}")
+            else:
+                if job.archive:
+                    job.file.archived = True
+                    collected.append(job)
+        return collected + self.uploads.collect()
+
+    def finish(self):
+        """Waits for both stages, see UploadQueue.finish
+
+        Returns
+        -------
+        list
+            jobs that failed to encode or upload
+        """
+        failed = []
+        for job in self.encode_jobs:
+            try:
+                job.future.result()
+            except Exception as e:
+                job.error = e
+                failed.append(job)
+                print_error(f"Encoding of {job.clip.title} failed: {e}")
+            else:
+                if job.archive:
+                    job.file.archived = True
+        self.encode_executor.shutdown()
+
+        self.encoded.put(None)
+        self.dispatcher.join()
+        self.encode_jobs = []
+        return failed + self.uploads.finish()
@@ -1,26 +1,29 @@
-"""Code for uploading clips to youtube using their API"""
-import httplib2
+"""Code for uploading clips to youtube using their API
+
+The API client libraries are slow to import, they're only loaded by the
+functions that talk to the API.
+"""
 import http.client
+import json
+import mimetypes
+import os
+import random
 import sys
+import threading
 import time
-from initconfig import CLIENT_SECRETS_FILE, YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, YOUTUBE_UPLOAD_SCOPE, DEFAULT_TAGS
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-from apiclient.http import MediaFileUpload
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client.tools import argparser, run_flow
+from datetime import datetime
+import initconfig
+from instrument import stage
 
 
-# Explicitly tell the underlying HTTP transport library not to retry, since
-# we are handling retry logic ourselves.
-httplib2.RETRIES = 1
+def retriable_exceptions():
+    """Always retry when these exceptions are raised."""
+    import httplib2
 
-# Always retry when these exceptions are raised.
-RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, http.client.NotConnected,
-                        http.client.IncompleteRead, http.client.ImproperConnectionState,
-                        http.client.CannotSendRequest, http.client.CannotSendHeader,
-                        http.client.ResponseNotReady, http.client.BadStatusLine)
+    return (httplib2.HttpLib2Error, IOError, http.client.NotConnected,
+            http.client.IncompleteRead, http.client.ImproperConnectionState,
+            http.client.CannotSendRequest, http.client.CannotSendHeader,
+            http.client.ResponseNotReady, http.client.BadStatusLine)
 
 # Always retry when an apiclient.errors.HttpError with one of these status
 # codes is raised.
@@ -29,23 +32,210 @@ RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 # Maximum number of times to retry before giving up.
 MAX_RETRIES = 10
 
+# In-flight upload sessions, so a restarted run resumes instead of starting over
+UPLOAD_JOURNAL_FILE = "upload_journal.json"
+
+DISCOVERY_FILE = "discovery-{name}-{version}.json"
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{name}/{version}/rest"
+
+# Credentials are refreshed this many seconds before they expire
+REFRESH_MARGIN = 300
+
+# Bytes drawn from the bandwidth limit at a time while a chunk is being sent
+THROTTLE_BLOCK_SIZE = 64 * 1024
+
+_credentials = None
+_credentials_lock = threading.Lock()
+_discovery = {}
+_discovery_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadJournal():
+    """Persists each in-flight upload's session URI and last acknowledged offset
+
+    Entries are keyed by the uploaded clip file.
+    """
+
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = os.path.join(initconfig.CACHE_FOLDER, UPLOAD_JOURNAL_FILE)
+        self.fname = fname
+        self.lock = threading.Lock()
+        try:
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.fname)
+
+    def record(self, clip_file: str, **fields):
+        with self.lock:
+            self.entries.setdefault(clip_file, {}).update(fields)
+            self.save()
+
+    def remove(self, clip_file: str):
+        with self.lock:
+            if self.entries.pop(clip_file, None) is not None:
+                self.save()
+
+    def pending(self):
+        with self.lock:
+            return dict(self.entries)
+
+
+def get_credentials(interactive=True):
+    """Stored OAuth credentials, shared by every thread
+
+    Parameters
+    ----------
+    interactive : bool, optional
+        run the browser flow if there are no valid credentials, otherwise
+        returns None, by default True
+    """
+    global _credentials
+    from oauth2client.client import flow_from_clientsecrets
+    from oauth2client.file import Storage
+    from oauth2client.tools import run_flow
+
+    with _credentials_lock:
+        if _credentials is None or _credentials.invalid:
+            storage = Storage("%s-oauth2.json" % sys.argv[0])
+            credentials = storage.get()
+
+            if credentials is None or credentials.invalid:
+                if not interactive:
+                    return None
+                flow = flow_from_clientsecrets(initconfig.CLIENT_SECRETS_FILE,
+                                               scope=initconfig.YOUTUBE_UPLOAD_SCOPE)
+                credentials = run_flow(flow, storage)
+            _credentials = credentials
+        return _credentials
+
+
+def discovery_document():
+    """The API's discovery document, cached locally so build doesn't fetch it every run
+
+    Looks in CACHE_FOLDER, then in the documents bundled with the API client
+    and only then goes to the network.
+    """
+    name, version = initconfig.YOUTUBE_API_SERVICE_NAME, initconfig.YOUTUBE_API_VERSION
+    fname = os.path.join(initconfig.CACHE_FOLDER,
+                         DISCOVERY_FILE.format(name=name, version=version))
+
+    with _discovery_lock:
+        if fname in _discovery:
+            return _discovery[fname]
+
+        document = None
+        if os.path.exists(fname):
+            with open(fname, "r") as f:
+                document = f.read()
+
+        if document is None:
+            try:
+                from googleapiclient.discovery_cache import get_static_doc
+                document = get_static_doc(name, version)
+            except ImportError:
+                pass
+
+        if document is None:
+            import httplib2
+
+            resp, content = httplib2.Http().request(
+                DISCOVERY_URL.format(name=name, version=version))
+            if int(resp.status) != 200:
+                raise UploadError(
+                    f"Couldn't fetch the discovery document ({resp.status}).")
+            document = content.decode()
+
+        if not os.path.exists(fname):
+            with open(fname, "w") as f:
+                f.write(document)
+
+        _discovery[fname] = document
+        return document
+
 
 def get_authenticated_service():
-    flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
-                                   scope=YOUTUBE_UPLOAD_SCOPE)
+    from apiclient.discovery import build_from_document
+
+    credentials = get_credentials()
+    return build_from_document(discovery_document(),
+                               http=credentials.authorize(upload_http()))
+
+
+def upload_http():
+    """httplib2.Http for the upload requests
+
+    Resumable sessions answer 308 (Resume Incomplete) to unfinished chunks and
+    offset queries, recent httplib2 versions would follow it as a redirect.
+    """
+    import httplib2
+
+    # Explicitly tell the underlying HTTP transport library not to retry, since
+    # we are handling retry logic ourselves.
+    httplib2.RETRIES = 1
+
+    http = httplib2.Http()
+    if hasattr(http, "redirect_codes"):
+        http.redirect_codes = http.redirect_codes - {308}
+    return http
 
-    storage = Storage("%s-oauth2.json" % sys.argv[0])
-    credentials = storage.get()
 
-    if credentials is None or credentials.invalid:
-        credentials = run_flow(flow, storage)
+class CredentialRefresher(threading.Thread):
+    """Keeps the stored credentials fresh in the background
 
-    return build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                 http=credentials.authorize(httplib2.Http()))
+    Also warms up the discovery document, so the first upload doesn't pay
+    for either. Does nothing if there are no stored credentials yet, the
+    first upload goes through the browser flow in that case.
+    """
 
+    def __init__(self, margin=REFRESH_MARGIN):
+        super().__init__(name="credential-refresher", daemon=True)
+        self.margin = margin
+        self.stopped = threading.Event()
 
-def initialize_upload(youtube, clip):
-    tags = DEFAULT_TAGS
+    def run(self):
+        import httplib2
+
+        try:
+            discovery_document()
+            credentials = get_credentials(interactive=False)
+        except Exception as e:
+            print(f"Couldn't prepare the upload service: {e}")
+            return
+        if credentials is None:
+            return
+
+        while not self.stopped.is_set():
+            if credentials.token_expiry is not None:
+                remaining = (credentials.token_expiry -
+                             datetime.utcnow()).total_seconds()
+                if self.stopped.wait(max(remaining - self.margin, 0)):
+                    return
+            try:
+                credentials.refresh(httplib2.Http())
+            except Exception as e:
+                print(f"Couldn't refresh credentials: {e}")
+                return
+            if credentials.token_expiry is None:
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+def initialize_upload(youtube, clip, journal=None, log=print):
+    tags = initconfig.DEFAULT_TAGS
 
     body = dict(
         snippet=dict(
@@ -58,47 +248,314 @@ def initialize_upload(youtube, clip):
             privacyStatus=clip.privacy_status
         )
     )
-    print(clip.clip_file_name)
+    log(clip.clip_file_name)
     insert_request = youtube.videos().insert(
         part=",".join(body.keys()),
         body=body,
-        media_body=MediaFileUpload(
-            clip.clip_file_name, chunksize=-1, resumable=True)
+        media_body=media_upload(clip.clip_file_name, initconfig.UPLOAD_CHUNK_SIZE)
     )
 
-    resumable_upload(insert_request)
+    if journal is None:
+        journal = UploadJournal()
+    size = os.path.getsize(clip.clip_file_name)
+    journal.record(clip.clip_file_name, source=clip.source,
+                   size=size, body=body, uri=None, offset=0)
 
+    return resumable_upload(insert_request, size, initconfig.UPLOAD_CHUNK_SIZE,
+                            journal=journal, journal_key=clip.clip_file_name, log=log)
 
-def resumable_upload(insert_request):
-    response = None
-    error = None
-    retry = 0
-    while response is None:
+
+class SessionJournalHttp():
+    """Wraps the request's http, journals the session URI the moment the server hands it out
+
+    googleapiclient starts the session and sends the first chunk (the whole
+    file if chunks are off) in the same next_chunk call, without this a run
+    killed during that chunk couldn't resume.
+    """
+
+    def __init__(self, http, insert_request, journal, journal_key):
+        self.http = http
+        self.insert_request = insert_request
+        self.journal = journal
+        self.journal_key = journal_key
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        if self.insert_request.resumable_uri is None and int(resp.status) == 200 and "location" in resp:
+            self.journal.record(self.journal_key, uri=resp["location"], offset=0)
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+_upload_bucket = None
+_upload_bucket_lock = threading.Lock()
+
+
+def upload_bucket():
+    """The TokenBucket every upload draws from, None if there's no bandwidth limit
+
+    Shared by all the upload threads, so UPLOAD_BANDWIDTH_LIMIT caps their
+    total rather than each of them.
+    """
+    global _upload_bucket
+    if not initconfig.UPLOAD_BANDWIDTH_LIMIT:
+        return None
+    with _upload_bucket_lock:
+        if _upload_bucket is None:
+            _upload_bucket = TokenBucket(initconfig.UPLOAD_BANDWIDTH_LIMIT)
+        return _upload_bucket
+
+
+def media_upload(clip_file: str, chunk_size: int):
+    """Resumable media body of clip_file, paced by upload_bucket() when there's a bandwidth limit"""
+    from apiclient.http import MediaFileUpload, MediaIoBaseUpload
+
+    bucket = upload_bucket()
+    if bucket is None:
+        return MediaFileUpload(clip_file, chunksize=chunk_size, resumable=True)
+    mimetype = mimetypes.guess_type(clip_file)[0] or "application/octet-stream"
+    return MediaIoBaseUpload(ThrottledReader(open(clip_file, "rb"), bucket), mimetype,
+                             chunksize=chunk_size, resumable=True)
+
+
+class ThrottledReader():
+    """File wrapper whose reads draw from a TokenBucket, THROTTLE_BLOCK_SIZE bytes at a time
+
+    googleapiclient streams each chunk from the file and the HTTP client
+    reads it as it sends it, so the upload is paced block by block instead of
+    going out in chunk sized bursts at line rate.
+    """
+
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = bytearray()
+        while size is None or size < 0 or len(data) < size:
+            want = THROTTLE_BLOCK_SIZE if size is None or size < 0 else min(THROTTLE_BLOCK_SIZE, size - len(data))
+            block = self.f.read(want)
+            if not block:
+                break
+            self.bucket.consume(len(block))
+            data += block
+        return bytes(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def query_upload_offset(http, uri: str, size: int):
+    """Asks the server how much of a resumable session it has
+
+    Parameters
+    ----------
+    http : httplib2.Http
+        any object with httplib2's request(uri, method, body, headers) signature
+    uri : str
+        resumable session URI
+    size : int
+        total size of the upload
+
+    Returns
+    -------
+    tuple
+        (offset, response), response is the parsed body once the upload is
+        complete, offset is None if the session no longer exists
+    """
+    resp, content = http.request(uri, method="PUT", body=b"",
+                                 headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"})
+    status = int(resp.status)
+    if status in (200, 201):
+        return size, json.loads(content or b"{}")
+    if status == 308:
+        # Range is inclusive, e.g bytes=0-524287, no Range means nothing was stored
+        received = resp.get("range")
+        offset = int(received.split("-")[-1]) + 1 if received else 0
+        return offset, None
+    if status in (404, 410):
+        return None, None
+    raise UploadError(
+        f"Unexpected status {status} while querying upload session: {content}")
+
+
+def resume_pending_uploads(youtube, journal=None):
+    """Continues the uploads left in the journal from the server's offset
+
+    Returns
+    -------
+    list
+        source paths of the clips whose upload finished
+    """
+    from apiclient.errors import HttpError
+
+    if journal is None:
+        journal = UploadJournal()
+
+    retriable = retriable_exceptions()
+    finished = []
+    for clip_file, entry in journal.pending().items():
+        if not entry.get("uri") or not os.path.exists(clip_file) or os.path.getsize(clip_file) != entry["size"]:
+            print(
+                f"Dropping upload session for {clip_file}, it can't be resumed.")
+            journal.remove(clip_file)
+            continue
+
+        # Failures leave the entry in the journal for the next run, they
+        # mustn't keep this one from starting
         try:
-            print("Uploading file...")
-            status, response = insert_request.next_chunk()
-            if response is not None:
+            offset, response = query_upload_offset(
+                youtube._http, entry["uri"], entry["size"])
+        except (UploadError, HttpError) + retriable as e:
+            print(f"Couldn't query the upload session for {clip_file}: {e}")
+            continue
+        if offset is None:
+            print(f"Upload session for {clip_file} expired.")
+            journal.remove(clip_file)
+            continue
+
+        print(
+            f"Resuming upload of {clip_file} from {format_bytes(offset)}/{format_bytes(entry['size'])}")
+        try:
+            if response is None:
+                # googleapiclient gets the range of a whole file (-1) upload
+                # that doesn't start at 0 wrong, the rest goes as one chunk
+                chunk_size = initconfig.UPLOAD_CHUNK_SIZE if initconfig.UPLOAD_CHUNK_SIZE > 0 else entry["size"]
+                body = entry["body"]
+                insert_request = youtube.videos().insert(
+                    part=",".join(body.keys()),
+                    body=body,
+                    media_body=media_upload(clip_file, chunk_size)
+                )
+                insert_request.resumable_uri = entry["uri"]
+                insert_request.resumable_progress = offset
+                response = resumable_upload(insert_request, entry["size"], chunk_size,
+                                            journal=journal, journal_key=clip_file, progress=offset)
+            else:
                 if 'id' in response:
                     print(
                         f"Video id '{response['id']}' was successfully uploaded.")
                 else:
-                    exit(
+                    print(
                         f"The upload failed with an unexpected response: {response}")
-        except HttpError as e:
-            if e.resp.status in RETRIABLE_STATUS_CODES:
-                error = f"A retriable HTTP error {e.resp.status} occurred:\n{e.content}"
-            else:
-                raise
-        except RETRIABLE_EXCEPTIONS as e:
-            error = f"A retriable error occurred: {e}"
-
-        if error is not None:
-            print(error)
-            retry += 1
-            if retry > MAX_RETRIES:
-                exit("No longer attempting to retry.")
-
-            max_sleep = 2 ** retry
-            sleep_seconds = random.random() * max_sleep
-            print(f"Sleeping {sleep_seconds} seconds and then retrying...")
-            time.sleep(sleep_seconds)
+                journal.remove(clip_file)
+        except (UploadError, HttpError) + retriable as e:
+            print(f"Couldn't resume upload of {clip_file}: {e}")
+            continue
+
+        if response is not None and 'id' in response:
+            finished.append(entry["source"])
+
+    return finished
+
+
+class TokenBucket():
+    """Limits throughput to rate bytes/s, allowing bursts of up to capacity bytes
+
+    Safe to share between threads, their combined throughput is limited.
+    """
+
+    def __init__(self, rate: int, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """Blocks until amount bytes can be sent"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.last) * self.rate)
+            self.last = now
+
+            # Chunks can be larger than the bucket, go into debt and wait it
+            # out, threads that consume meanwhile wait behind the debt
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def format_bytes(amount: float):
+    for unit in ("B", "KB", "MB", "GB"):
+        if amount < 1024:
+            return f"{amount:.1f}{unit}"
+        amount /= 1024
+    return f"{amount:.1f}TB"
+
+
+def resumable_upload(insert_request, total_size: int, chunk_size=None, journal=None, journal_key=None, progress=0, log=print):
+    """Uploads chunk by chunk, the retry backoff applies to each chunk
+
+    The session URI and acknowledged offset are kept in the journal until the
+    upload finishes, so it can be resumed by a later run.
+    """
+    from apiclient.errors import HttpError
+
+    if chunk_size is None:
+        chunk_size = initconfig.UPLOAD_CHUNK_SIZE
+    retriable = retriable_exceptions()
+    response = None
+    retry = 0
+    http = None
+    if journal is not None and insert_request.resumable_uri is None:
+        http = SessionJournalHttp(insert_request.http, insert_request, journal, journal_key)
+    log("Uploading file...")
+    with stage("upload", size=total_size) as event:
+        resumed_from = progress
+        event["retries"] = 0
+        while response is None:
+            error = None
+            chunk_start = time.monotonic()
+            try:
+                status, response = insert_request.next_chunk(http=http)
+                if status is not None:
+                    sent = status.resumable_progress - progress
+                    progress = status.resumable_progress
+                    event["bytes"] = progress - resumed_from
+                    speed = sent / max(time.monotonic() - chunk_start, 1e-6)
+                    eta = (total_size - progress) / speed if speed else 0
+                    log(
+                        f"Uploaded {format_bytes(progress)}/{format_bytes(total_size)} ({status.progress():.1%}) at {format_bytes(speed)}/s, ETA {eta:.0f}s")
+                    retry = 0
+                    if journal is not None:
+                        journal.record(
+                            journal_key, uri=insert_request.resumable_uri, offset=progress)
+                if response is not None:
+                    if 'id' in response:
+                        event["bytes"] = total_size - resumed_from
+                        log(
+                            f"Video id '{response['id']}' was successfully uploaded.")
+                        if journal is not None:
+                            journal.remove(journal_key)
+                    else:
+                        raise UploadError(
+                            f"The upload failed with an unexpected response: {response}")
+            except HttpError as e:
+                if e.resp.status in RETRIABLE_STATUS_CODES:
+                    error = f"A retriable HTTP error {e.resp.status} occurred:\n{e.content}"
+                else:
+                    raise
+            except retriable as e:
+                error = f"A retriable error occurred: {e}"
+
+            if error is not None:
+                log(error)
+                if journal is not None and insert_request.resumable_uri:
+                    journal.record(journal_key, uri=insert_request.resumable_uri)
+                retry += 1
+                event["retries"] += 1
+                if retry > MAX_RETRIES:
+                    raise UploadError(
+                        "No longer attempting to retry, the upload can be resumed on the next run.")
+
+                max_sleep = 2 ** retry
+                sleep_seconds = random.random() * max_sleep
+                log(f"Sleeping {sleep_seconds} seconds and then retrying...")
+                time.sleep(sleep_seconds)
+
+    return response
@@ -0,0 +1,133 @@
+"""Watches the video folder and reports clips once NVIDIA has finished writing them."""
+import os
+import threading
+import time
+import initconfig
+from scanner import VIDEO_EXTENSION, ClipScanner
+
+
+class ClipWatcher():
+    """Collects clips created, changed, moved or deleted under root
+
+    Filesystem events come from watchdog (inotify, ReadDirectoryChangesW...)
+    when it's installed, otherwise the folder is polled with the incremental
+    ClipScanner. Either way a clip is only reported once its size and mtime
+    haven't changed for stable_seconds, and events for the same clip are
+    merged, so copying a whole folder in produces one batch instead of a
+    stream of partial files.
+    """
+
+    def __init__(self, root=None, stable_seconds=None, poll_seconds=None):
+        if root is None:
+            root = initconfig.VIDEO_FOLDER
+        self.root = os.path.abspath(root)
+        self.stable_seconds = initconfig.WATCH_STABLE_SECONDS if stable_seconds is None else stable_seconds
+        self.poll_seconds = initconfig.WATCH_POLL_SECONDS if poll_seconds is None else poll_seconds
+
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.removed = set()
+        # path -> ((size, mtime), monotonic time it last changed)
+        self.pending = {}
+
+        self.scanner = ClipScanner(self.root)
+        self.observer = self.start_observer()
+        # Clips that landed or were deleted while nothing was watching
+        self.rescan()
+
+    @property
+    def mode(self):
+        return "filesystem events" if self.observer else f"polling every {self.poll_seconds}s"
+
+    def start_observer(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return None
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_created(self, event):
+                watcher.notify(event.src_path)
+
+            def on_modified(self, event):
+                watcher.notify(event.src_path)
+
+            def on_moved(self, event):
+                watcher.notify_removed(event.src_path)
+                watcher.notify(event.dest_path)
+
+            def on_deleted(self, event):
+                watcher.notify_removed(event.src_path)
+
+        observer = Observer()
+        observer.schedule(Handler(), self.root, recursive=True)
+        observer.daemon = True
+        observer.start()
+        return observer
+
+    def is_clip(self, path: str):
+        """Clips in the root or a game folder, like ClipScanner"""
+        folder = os.path.dirname(os.path.abspath(path))
+        return path.lower().endswith(VIDEO_EXTENSION) and (
+            folder == self.root or os.path.dirname(folder) == self.root)
+
+    def notify(self, path: str):
+        if self.is_clip(path):
+            with self.lock:
+                self.changed.add(path)
+                self.removed.discard(path)
+
+    def notify_removed(self, path: str):
+        if self.is_clip(path):
+            with self.lock:
+                self.removed.add(path)
+                self.changed.discard(path)
+
+    def rescan(self):
+        """Notifies the clips the scanner found changed, and the ones it no longer finds"""
+        known = self.scanner.clip_paths()
+        for _, path in self.scanner.scan(changed_only=True):
+            self.notify(path)
+        for path in known - self.scanner.clip_paths():
+            self.notify_removed(path)
+
+    def poll(self):
+        """Returns (clips that finished writing, clips that were removed) since the last call"""
+        if self.observer is None:
+            self.rescan()
+
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            removed, self.removed = self.removed, set()
+
+        for path in changed:
+            # Checked again below, a new event restarts the wait
+            self.pending[path] = None
+        for path in removed:
+            self.pending.pop(path, None)
+
+        now = time.monotonic()
+        ready = []
+        for path, seen in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            stamp = (st.st_size, st.st_mtime_ns)
+            if seen is None or seen[0] != stamp:
+                self.pending[path] = (stamp, now)
+            elif now - seen[1] >= self.stable_seconds:
+                del self.pending[path]
+                ready.append(path)
+
+        return sorted(ready), sorted(removed)
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
@@ -0,0 +1,188 @@
+"""Pluggable watchlist backends, the plain text file or an SQLite database."""
+import os
+import sqlite3
+import termtables as tt
+import initconfig
+from helpers import (Watchlist, WatchlistFile, media_summary, missing_files, print_info, read_watchlist_file,
+                     warn_missing, write_watchlist_file)
+
+# Flags that are persisted, missing is worked out when loading
+STORED_FLAGS = ('ignored', 'archived', 'uploaded')
+STORED_COLUMNS = STORED_FLAGS + ('fingerprint',)
+
+
+class WatchlistStore():
+    """Base backend, loads/saves a Watchlist and is told about each change"""
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, watchlist: Watchlist, verbose=True):
+        raise NotImplementedError
+
+    def counts(self):
+        """Returns {'total': n, 'ignored': n, 'archived': n, 'uploaded': n}"""
+        watchlist = self.load()
+        counts = {flag: getattr(watchlist, f'{flag}_count')
+                  for flag in STORED_FLAGS}
+        counts['total'] = len(watchlist)
+        return counts
+
+    def status(self):
+        return str(self.load())
+
+    def file_added(self, f: WatchlistFile):
+        pass
+
+    def file_removed(self, f: WatchlistFile):
+        pass
+
+    def file_updated(self, f: WatchlistFile, flag: str, value: bool):
+        pass
+
+    def file_moved(self, f: WatchlistFile, previous: str):
+        pass
+
+
+class TextWatchlistStore(WatchlistStore):
+    """The whole watchlist is rewritten on save"""
+
+    def __init__(self, fname=None):
+        self.fname = initconfig.WATCHLIST_FILE if fname is None else fname
+
+    def load(self):
+        return read_watchlist_file(self.fname)
+
+    def save(self, watchlist: Watchlist, verbose=True):
+        write_watchlist_file(watchlist, verbose=verbose, fname=self.fname)
+
+
+class SqliteWatchlistStore(WatchlistStore):
+    """Each change to a loaded watchlist is committed as its own transaction"""
+
+    def __init__(self, database=None, import_from=None):
+        if database is None:
+            database = initconfig.WATCHLIST_DATABASE
+        if import_from is None:
+            import_from = initconfig.WATCHLIST_FILE
+        created = not os.path.exists(database)
+        self.conn = sqlite3.connect(database)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                ignored INTEGER NOT NULL DEFAULT 0,
+                archived INTEGER NOT NULL DEFAULT 0,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                fingerprint TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_ignored ON files (ignored);
+            CREATE INDEX IF NOT EXISTS files_archived ON files (archived);
+            CREATE INDEX IF NOT EXISTS files_uploaded ON files (uploaded);
+        """)
+        columns = [row[1]
+                   for row in self.conn.execute("PRAGMA table_info(files)")]
+        if 'fingerprint' not in columns:
+            with self.conn:
+                self.conn.execute(
+                    "ALTER TABLE files ADD COLUMN fingerprint TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint)")
+
+        if created and import_from and os.path.exists(import_from):
+            self.import_text(import_from)
+
+    def import_text(self, fname: str):
+        print_info(f"Importing {fname} into the watchlist database...")
+        watchlist = read_watchlist_file(fname)
+        self.replace_all(watchlist)
+        print_info(f"Imported {len(watchlist)} files.")
+
+    def load(self):
+        print_info("Reading watchlist database...")
+        watchlist = Watchlist()
+        rows = self.conn.execute(
+            "SELECT path, ignored, archived, uploaded, fingerprint FROM files ORDER BY rowid").fetchall()
+        missing = missing_files(row[0] for row in rows)
+        for path, ignored, archived, uploaded, fingerprint in rows:
+            watchlist.add_file(WatchlistFile(path, bool(ignored), bool(archived), bool(uploaded),
+                                             missing=path in missing, fingerprint=fingerprint))
+
+        # Attached after loading so the rows above aren't written back
+        watchlist.store = self
+        warn_missing(missing)
+        print_info(
+            f"Successfully read watchlist database! {len(watchlist)} files read. {len(missing)} files missing.")
+        return watchlist
+
+    def save(self, watchlist: Watchlist, verbose=True):
+        # Changes to watchlists loaded from this store are already committed
+        if watchlist.store is not self:
+            self.replace_all(watchlist)
+            watchlist.store = self
+        if verbose:
+            print_info("Watchlist database is up to date.")
+
+    def replace_all(self, watchlist: Watchlist):
+        with self.conn:
+            self.conn.execute("DELETE FROM files")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, ignored, archived, uploaded, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                (self.row(f) for f in watchlist.files))
+
+    def counts(self):
+        counts = {'total': self.conn.execute(
+            "SELECT COUNT(*) FROM files").fetchone()[0]}
+        for flag in STORED_FLAGS:
+            # flag comes from STORED_FLAGS, never from input
+            counts[flag] = self.conn.execute(
+                f"SELECT COUNT(*) FROM files WHERE {flag} = 1").fetchone()[0]
+        return counts
+
+    def status(self):
+        rows = self.conn.execute(
+            "SELECT path, ignored, archived, uploaded FROM files ORDER BY rowid").fetchall()
+        if not rows:
+            return ""
+
+        header = ["Filepath", "Ignored", "Archived", "Uploaded", "Media"]
+        data = [[path, bool(i), bool(a), bool(u), media_summary(path)]
+                for path, i, a, u in rows]
+        counts = self.counts()
+        stats = f"\nTotal: {counts['total']} Ignored: {counts['ignored']} Archived: {counts['archived']} Uploaded: {counts['uploaded']}"
+        return tt.to_string(data, header=header) + stats
+
+    @staticmethod
+    def row(f: WatchlistFile):
+        return (f.filepath, int(f.ignored), int(f.archived), int(f.uploaded), f.fingerprint)
+
+    def file_added(self, f: WatchlistFile):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, ignored, archived, uploaded, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                self.row(f))
+
+    def file_removed(self, f: WatchlistFile):
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (f.filepath,))
+
+    def file_updated(self, f: WatchlistFile, flag: str, value):
+        if flag not in STORED_COLUMNS:
+            return
+        if flag in STORED_FLAGS:
+            value = int(value)
+        with self.conn:
+            self.conn.execute(
+                f"UPDATE files SET {flag} = ? WHERE path = ?", (value, f.filepath))
+
+    def file_moved(self, f: WatchlistFile, previous: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE files SET path = ? WHERE path = ?", (f.filepath, previous))
+
+
+def open_watchlist_store(backend=None):
+    if backend is None:
+        backend = initconfig.WATCHLIST_BACKEND
+    if backend == 'sqlite':
+        return SqliteWatchlistStore()
+    return TextWatchlistStore()